@@ -8,17 +8,22 @@ LRS.orbit_data(orbitname)
 """
 
 import os
+import re
 import sys
-import glob
-import copy
+import shutil
+import pickle
+import functools
 import logging
+from collections import Counter
 import numpy as np
 import pandas as pd
 import requests
 import urllib
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pyproj
 from datetime import datetime
-from shapely.geometry import Point, Polygon
+from concurrent.futures import ThreadPoolExecutor
 from scipy.interpolate import UnivariateSpline
 from joblib import Parallel, delayed
 from pyproj import CRS
@@ -27,11 +32,120 @@ import matplotlib.pyplot as plt
 from . import read, tools, processing
 
 
+# Track identifier (e.g., '20071221033918') within a filename
+_NAME_RE = re.compile(r'_(\d{14})(?=[._])')
+
+# Spherical Moon used for geodesic distances
+_MOON_GEOD = pyproj.Geod(a=1737400, b=1737400)
+
+# Version of the index cache content. Increase it when the content changes
+_INDEX_VERSION = 2
+
+
+@functools.lru_cache(maxsize=16)
+def _read_csvs(filenames, mtimes):
+    """ Concatenate all columns from csv files. Results are cached on the 
+    filenames and their modification times
+    """
+    dfs = [pd.read_csv(filename, engine='c') for filename in filenames]
+    return pd.concat(dfs, axis=1)
+
+
+@functools.lru_cache(maxsize=16)
+def _read_img(img_filename, lbl_filename, mtimes):
+    """ Memory-map a binary LRS file (read-only). Results are cached on the 
+    filenames and their modification times. Memory maps hold no image data
+    """
+    return read.img(img_filename, lbl_filename, mmap=True)
+
+
+def _power(img, Pmax, Pmin, out=None):
+    """ Convert orig 8-bit samples to power [dB], optionally into a 
+    preallocated float32 array
+    """
+    if out is None:
+        out = np.empty(np.shape(img), dtype=np.float32)
+    np.subtract(255, img, out=out, dtype=np.float32)
+    out *= np.float32((Pmax-Pmin)/255)
+    out += np.float32(Pmin)
+    return out
+
+
+class _PowerImage():
+    """ Lazy gain correction of a (memory-mapped) orig image. Slicing it
+    returns the power [dB] of the sliced samples only
+    """
+    def __init__(self, img, Pmax, Pmin):
+        self.img = img
+        self.Pmax = Pmax
+        self.Pmin = Pmin
+        self.shape = img.shape
+        
+    def __getitem__(self, key):
+        return self.read(key)
+    
+    def read(self, key):
+        """ Power of a slice of the image
+        """
+        return _power(self.img[key], self.Pmax, self.Pmin)
+    
+    def __array__(self, dtype=None):
+        out = self[...]
+        return out if dtype is None else out.astype(dtype)
+
+
+@functools.lru_cache(maxsize=8)
+def _transformer(crs_from, crs_to):
+    """ Transformer between two PROJ strings. It is built once for each pair
+    """
+    return Transformer.from_crs(CRS.from_string(crs_from), 
+                                CRS.from_proj4(crs_to))
+
+
+def _roll_columns(rdg, shifts, max_groups=16):
+    """ Roll each column of a radargram along range by its own shift, 
+    in place. Columns beyond the length of shifts are left untouched.
+    Columns sharing a shift are rolled together by contiguous slice copies. 
+    When there are more than max_groups distinct shifts, all columns are 
+    rolled at once by a fancy-indexing gather
+    """
+    nrows = rdg.shape[0]
+    n = min(rdg.shape[1], len(shifts))
+    shifts = np.asarray(shifts[:n], dtype=np.intp) % nrows
+    values = np.unique(shifts)
+    
+    if len(values) > max_groups:
+        rows = (np.arange(nrows)[:, None] - shifts[None, :]) % nrows
+        rdg[:, :n] = rdg[rows, np.arange(n)[None, :]]
+        return
+    
+    for shift in values:
+        if len(values) == 1:
+            cols = slice(0, n)
+        else:
+            cols = np.flatnonzero(shifts == shift)
+        rdg[:, cols] = np.roll(rdg[:, cols], shift, axis=0)
+
+
+def _mtimes(filenames):
+    """ Modification times of a list of files
+    """
+    return tuple(os.path.getmtime(filename) for filename in filenames)
+
+
 class Env:
     """ Class for interacting with data files in the dataset
     """
-    def __init__(self, root_path = os.path.join('..', '')):
+    def __init__(self, root_path = os.path.join('..', ''), refresh=False):
         """ Get various parameters defining the dataset
+        
+        ARGUMENTS
+        ---------
+        root_path: string
+            root of the code and data hierarchy
+        refresh: binary
+            Whether to rebuild the file index and re-parse all label files 
+            instead of using the index and label caches
         """
         self.remote_host = 'https://data.darts.isas.jaxa.jp/pub/pds3/'
         self.root_path = root_path
@@ -40,14 +154,44 @@ class Env:
         self.orig_path = os.path.join(self.data_path, 'orig', 'lrs', '')#self.data_path + 'orig/lrs/'
         self.xtra_path = os.path.join(self.data_path, 'xtra', 'lrs', '')#self.data_path + 'xtra/lrs/'
         self.files = {}
+        self.file_types = {}
         self.clock_lim = {}
         self.epoch_lim = {}
         self.lat_lim = {}
         self.lon_lim = {}
+        self._epoch_arr = {}
+        self._cal = {}
+        self._product_matches = {}
+        self._lat_monotonic = {}
+        # Processes run by Env.run: (function, default method, archive extension,
+        # joblib backend preference of Env.run_all). anc and sgy are I/O-bound 
+        # (anc SPICE calls are serialized in read.spice_kernels), srf is CPU-bound
+        self._processes = {'anc':(processing.anc, None, '.txt', 'threads'),
+                           'srf':(processing.srf, 'mouginot2010', '.txt', 'processes'),
+                           'sgy':(processing.sgy, None, '.sgy', 'threads'),
+                          }
+        # Lon/lat to south polar stereographic transformer
+        crs_lonlat = CRS.from_string("+proj=longlat +R=1737400 +no_defs")
+        crs_stereo = CRS.from_proj4("+proj=stere +lat_0=-90 +lon_0=0 +k=1 +x_0=0 +y_0=0 +R=1737400 +units=m +no_defs +type=crs")
+        self._stereo_transformer = Transformer.from_crs(crs_lonlat, crs_stereo, 
+                                                        always_xy=True)
+        # Persistent HTTP session so that bulk downloads reuse connections
+        self._session = requests.Session()
+        retries = Retry(total=3, backoff_factor=0.5, 
+                        status_forcelist=[500, 502, 503, 504])
+        self._session.mount('https://', HTTPAdapter(pool_connections=10, 
+                                                    pool_maxsize=20, 
+                                                    max_retries=retries))
         self.initialize_hierarchy()
         self.products = self.index_products()
-        self.index_files()
-        self.read_labels()
+        self._product_matches.update(self.index_product_names())
+        self.index_cache = os.path.join(os.path.expanduser('~'), '.cache', 
+                                        'lrs', 'index.pkl')
+        self.label_cache = os.path.join(self.xtra_path, '_label_cache.csv')
+        if refresh or not self.load_index():
+            self.index_files()
+            self.read_labels(refresh=refresh)
+            self.save_index()
         
     def initialize_hierarchy(self):
         paths = [self.data_path,
@@ -56,7 +200,7 @@ class Env:
                 ]
         
         for path in paths:
-            if not glob.glob(path):
+            if not os.path.isdir(path):
                 os.makedirs(path)
                 logging.info(path + ' CREATED')
         
@@ -64,16 +208,36 @@ class Env:
     def index_products(self, path=False):
         """List available products
         """
-        out = os.listdir(self.orig_path)
+        with os.scandir(self.orig_path) as entries:
+            out = [entry.name for entry in entries if entry.is_dir()]
         
-        for xtra in os.listdir(self.xtra_path):
-            products = os.listdir(os.path.join(self.xtra_path, xtra))
-            out.extend(products)
+        with os.scandir(self.xtra_path) as xtras:
+            for xtra in xtras:
+                if xtra.is_dir():
+                    with os.scandir(xtra.path) as entries:
+                        out.extend([entry.name for entry in entries if entry.is_dir()])
         
         out = list(set(out)) # unique products
         return out
         
         
+    def index_product_names(self):
+        """ Map the product full names and their unambiguous short names 
+        (e.g., sar05) to the product full names
+        
+        RETURN
+        ------
+        dict {name: product}
+        """
+        out = {product: product for product in self.products}
+        for product in self.products:
+            for token in product.split('-'):
+                matches = [i for i in self.products if token in i]
+                if matches == [product]:
+                    out.setdefault(token, product)
+        return out
+        
+        
     def product_match(self, product):
         """ Return the full name of a product from a substring
         
@@ -86,6 +250,9 @@ class Env:
         ------
         string
         """
+        if product in self._product_matches:
+            return self._product_matches[product]
+        
         res = [i for i in self.products if product in i]
         
         if len(res) > 1:
@@ -93,6 +260,7 @@ class Env:
             for i in res:
                 print(i)
         else:
+            self._product_matches[product] = res[0]
             return res[0]
 
         
@@ -126,16 +294,33 @@ class Env:
         remote_file = urllib.parse.urljoin(self.remote_host, product + '/' + name[:8] + '/data' + '/' + filename)
         local_file = os.path.join(self.orig_path, product, name[:8], 'data', filename)
         
-        if not glob.glob(local_file) or delete:
+        if not os.path.exists(local_file) or delete:
+            if delete:
+                # Drop cached reads of the file being replaced
+                self.invalidate_cache()
+                if os.path.exists(self.index_cache):
+                    os.remove(self.index_cache)
             # Download file
             os.makedirs(os.path.join(self.orig_path, product, name[:8], 'data'), exist_ok=True)
-            response = requests.get(remote_file)
-            if response.status_code == 200:
-                open(local_file, "wb").write(response.content)
-                out_code = 1
-                logging.info(f' [{out_code}] {local_file} DOWNLOADED')
-            else:
-                logging.info(' ' + remote_file + f' DOES NOT EXIST (Error {response.status_code})')
+            with self._session.get(remote_file, stream=True, timeout=60) as response:
+                if response.status_code == 200:
+                    # Stream to disk by 1 MB chunks, in a partial file moved 
+                    # in place only once complete
+                    response.raw.decode_content = True
+                    part_file = local_file + '.part'
+                    try:
+                        with open(part_file, "wb") as f:
+                            shutil.copyfileobj(response.raw, f, length=1<<20)
+                        os.replace(part_file, local_file)
+                    except BaseException:
+                        if os.path.exists(part_file):
+                            os.remove(part_file)
+                        raise
+                    out_code = 1
+                    logging.info(f' [{out_code}] {local_file} DOWNLOADED')
+                else:
+                    out_code = 0
+                    logging.info(' ' + remote_file + f' DOES NOT EXIST (Error {response.status_code})')
         elif delete_only == True:
             # Erase local file only
             os.remove(local_file)
@@ -149,6 +334,55 @@ class Env:
         return out_code
     
     
+    def invalidate_cache(self):
+        """ Drop the cached file reads and the parameters derived from them
+        """
+        _read_csvs.cache_clear()
+        _read_img.cache_clear()
+        self._cal = {}
+        self._lat_monotonic = {}
+    
+    
+    def _download_one(self, task):
+        """ Download a (product, name, typ) task. Used by the threaded 
+        bulk downloads
+        """
+        product, name, typ = task
+        logging.info(f' Downloading {product} {name} {typ}')
+        return self.download(product, name, typ=typ)
+    
+    
+    def download_many(self, tasks, max_workers=10):
+        """ Download several files concurrently through the HTTP session
+        
+        ARGUMENTS
+        ---------
+        tasks: list
+            [product, name, typ] of the files to download
+        max_workers: integer
+            Number of concurrent downloads
+        
+        RETURN
+        ------
+        list of download output codes (see download)
+        """
+        with ThreadPoolExecutor(max_workers=max_workers) as ex:
+            return list(ex.map(self._download_one, tasks))
+    
+    
+    def close(self):
+        """ Close the HTTP session used for downloads
+        """
+        self._session.close()
+        
+        
+    def __del__(self):
+        try:
+            self.close()
+        except AttributeError:
+            pass
+    
+    
     def filename_root(self, product, name):
         """ output the filename of a product track following the JAXA convention
         """
@@ -167,6 +401,25 @@ class Env:
         return filename
     
         
+    def _scan_product(self, path):
+        """ Yield the DirEntry of every file within the <day>/data folders 
+        of a product path, in a single os.scandir pass
+        """
+        if not os.path.isdir(path):
+            return
+        with os.scandir(path) as days:
+            for day in days:
+                if not day.is_dir():
+                    continue
+                try:
+                    with os.scandir(os.path.join(day.path, 'data')) as entries:
+                        for entry in entries:
+                            if entry.is_file() and '.' in entry.name[1:]:
+                                yield entry
+                except FileNotFoundError:
+                    continue
+    
+    
     def index_files(self):
         """ Index all data files 
         """
@@ -175,85 +428,267 @@ class Env:
         logging.info(f' {cols[1]:^37} {cols[2]:>7} {cols[3]:>7} {cols[4]:>7} {cols[5]:>7} {cols[6]:>7}')
         logging.info(f' {cols[0]:^37} {cols[0]:>7} {cols[0]:>7} {cols[0]:>7} {cols[0]:>7} {cols[0]:>7}')
 
-        # list products
-        for product in self.products:
-            # Indicate below what folders need to be indexed
-            index_paths = [os.path.join(self.orig_path, product),
-                           os.path.join(self.xtra_path, 'anc', product),
-                           os.path.join(self.xtra_path, 'srf', product),
-                           os.path.join(self.xtra_path, 'sim', product),]
-            
-            self.files[product] = {}
-            for path in index_paths:
-                if os.path.exists(path):
-                    for day in os.listdir(path):
-                        search_path = os.path.join(path, day, 'data', '*.*')
-                        filenames = glob.glob(search_path)
-                        #filenames = glob.glob(path + '/' + day + '/data/*.*')
-                        for filename in filenames:
-                            name = [i for i in filename.split('_') 
-                                    if '200' in i][-1][:14]
-                            #name = filename.split('_')[-1][:14]
-                            if name not in self.files[product].keys():
-                                self.files[product][name] = {}
-                                self.files[product][name] = [filename]
-                            else:
-                                self.files[product][name].append(filename)
-                                
-            # Sort files by type
-            files = []
-            for track in self.files[product]:
-                track_files = self.files[product][track]
-                files = np.concatenate((files, track_files), axis=0)
-                
-            lbl_files = [file for file in files if "lbl" in file]
-            img_files = [file for file in files if "img" in file]
-            anc_files = [file for file in files if "anc" in file]
-            srf_files = [file for file in files if "srf" in file]
-            sim_files = [file for file in files if "sim" in file]
-
-            logging.info(f' {product:<37} {str(len(lbl_files)):>7}' + 
-                         f' {str(len(img_files)):>7} {str(len(anc_files)):>7}' + 
-                         f' {str(len(srf_files)):>7} {str(len(sim_files)):>7}'
+        # Scan products concurrently, since the work is I/O-bound
+        with ThreadPoolExecutor(max_workers=max(len(self.products), 1)) as ex:
+            results = list(ex.map(self._index_one_product, self.products))
+        
+        for product, (files, file_types, counts) in zip(self.products, results):
+            self.files[product] = files
+            self.file_types[product] = file_types
+            logging.info(f' {product:<37} {str(counts["lbl"]):>7}' + 
+                         f' {str(counts["img"]):>7} {str(counts["anc"]):>7}' + 
+                         f' {str(counts["srf"]):>7} {str(counts["sim"]):>7}'
                         )
             
+            
+    def _index_one_product(self, product):
+        """ Index the data files of a product
+        
+        RETURN
+        ------
+        files, file_types, counts of files per type
+        """
+        # Indicate below what folders need to be indexed
+        index_paths = {'orig':os.path.join(self.orig_path, product),
+                       'anc':os.path.join(self.xtra_path, 'anc', product),
+                       'srf':os.path.join(self.xtra_path, 'srf', product),
+                       'sim':os.path.join(self.xtra_path, 'sim', product),}
+        
+        files = {}
+        file_types = {}
+        counts = Counter()
+        for typ, path in index_paths.items():
+            for entry in self._scan_product(path):
+                match = _NAME_RE.search(entry.name)
+                if not match:
+                    continue
+                name = match.group(1)
+                files.setdefault(name, []).append(entry.path)
+                # Sort files by type
+                types = file_types.setdefault(name, 
+                    {'lbl':None, 'img':None, 'anc':[], 'srf':[], 'sim':[]})
+                if typ == 'orig':
+                    ext = entry.name.split('.')[-1]
+                    if ext in ['lbl', 'img'] and not types[ext]:
+                        types[ext] = entry.path
+                    counts[ext] += 1
+                else:
+                    types[typ].append(entry.path)
+                    counts[typ] += 1
+        
+        return files, file_types, counts
+            
 
-    def read_labels(self):
-        """ Read and store in the Class some parameters from the label files
+    def _parse_one_lbl(self, lbl_filename):
+        """ Read the clock, epoch, latitude and longitude limits of a track 
+        from its label file
+        
+        RETURN
+        ------
+        clock_lim, epoch_lim, lat_lim, lon_lim
+        """
+        keys = read.lbl_all(lbl_filename)
+        # Clock
+        clock = [keys['START_TIME'], keys['STOP_TIME']]
+        epoch = [datetime.strptime(lim, "%Y-%m-%dT%H:%M:%S").timestamp() 
+                 for lim in clock]
+        # Latitude
+        lat = [keys['START_SUB_SPACECRAFT_LATITUDE'], 
+               keys['STOP_SUB_SPACECRAFT_LATITUDE']]
+        # Longitude
+        lon = [keys['START_SUB_SPACECRAFT_LONGITUDE'], 
+               keys['STOP_SUB_SPACECRAFT_LONGITUDE']]
+        return clock, epoch, lat, lon
+    
+    
+    def index_signature(self):
+        """ Signature of the data hierarchy, used to validate the index 
+        cache. It holds the latest modification time of the folders containing
+        data files, so that adding or removing a file changes it
+        """
+        mtimes = []
+        roots = [self.orig_path] + [os.path.join(self.xtra_path, xtra) 
+                                    for xtra in ['anc', 'srf', 'sim']]
+        for root in roots:
+            for product in self.products:
+                path = os.path.join(root, product)
+                if not os.path.isdir(path):
+                    continue
+                mtimes.append(os.path.getmtime(path))
+                with os.scandir(path) as days:
+                    for day in days:
+                        data_path = os.path.join(day.path, 'data')
+                        if day.is_dir() and os.path.isdir(data_path):
+                            mtimes.append(os.path.getmtime(data_path))
+        
+        return (_INDEX_VERSION, os.path.abspath(self.root_path), 
+                sorted(self.products), max(mtimes, default=0))
+    
+    
+    def load_index(self):
+        """ Restore the file index and the label parameters from the index 
+        cache if the data hierarchy did not change since it was saved
+        
+        RETURN
+        ------
+        True if the index has been loaded
+        """
+        try:
+            with open(self.index_cache, 'rb') as f:
+                cache = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return False
+        
+        if cache.get('signature') != self.index_signature():
+            return False
+        
+        self.files = cache['files']
+        self.file_types = cache['file_types']
+        self.clock_lim = cache['clock_lim']
+        self.epoch_lim = cache['epoch_lim']
+        self.lat_lim = cache['lat_lim']
+        self.lon_lim = cache['lon_lim']
+        self.index_epochs()
+        self.index_tracks()
+        logging.info(' Index loaded from ' + self.index_cache)
+        return True
+    
+    
+    def save_index(self):
+        """ Save the file index and the label parameters to the index cache
         """
+        cache = {'signature':self.index_signature(),
+                 'files':self.files,
+                 'file_types':self.file_types,
+                 'clock_lim':self.clock_lim,
+                 'epoch_lim':self.epoch_lim,
+                 'lat_lim':self.lat_lim,
+                 'lon_lim':self.lon_lim,
+                }
+        try:
+            os.makedirs(os.path.dirname(self.index_cache), exist_ok=True)
+            with open(self.index_cache, 'wb') as f:
+                pickle.dump(cache, f)
+        except OSError:
+            logging.warning('Index cache could not be written to ' + self.index_cache)
+    
+    
+    def read_labels(self, n_jobs=8, refresh=False):
+        """ Read and store in the Class some parameters from the label files.
+        Label files are parsed in a thread pool since the work is I/O-bound. 
+        The parameters are also kept in a label cache file in xtra_path, so 
+        that only new or modified label files are parsed again
+        
+        ARGUMENTS
+        ---------
+        n_jobs: integer
+            Number of threads reading the label files
+        refresh: binary
+            Whether to re-parse all label files, ignoring the label cache
+        """
+        tasks = []
         for product in self.files.keys():
             self.clock_lim[product] = {}
             self.epoch_lim[product] = {}
             self.lat_lim[product] = {}
             self.lon_lim[product] = {}
-            for name in self.files[product].keys():
-                lbl_filenames = [file for file in self.files[product][name] if '.lbl' in file]
-                if lbl_filenames:
-                    try:
-                        lbl_filename = lbl_filenames[0]
-                    except:
-                        logging.error(f'{product}/{name} label file is corrupted or non-existent')
-                    # Clock
-                    lim1 = read.lbl_keyword(lbl_filename, 'START_TIME')
-                    lim2 = read.lbl_keyword(lbl_filename, 'STOP_TIME')
-                    self.clock_lim[product][name] = [lim1, lim2]
-                    self.epoch_lim[product][name] = [datetime.strptime(lim1, "%Y-%m-%dT%H:%M:%S").timestamp(),
-                                                     datetime.strptime(lim2, "%Y-%m-%dT%H:%M:%S").timestamp()]
-                    # Latitude
-                    lim1 = read.lbl_keyword(lbl_filename, 
-                                            'START_SUB_SPACECRAFT_LATITUDE')
-                    lim2 = read.lbl_keyword(lbl_filename, 
-                                            'STOP_SUB_SPACECRAFT_LATITUDE')
-                    self.lat_lim[product][name] = [lim1, lim2]
-                    # Longitude
-                    lim1 = read.lbl_keyword(lbl_filename, 
-                                            'START_SUB_SPACECRAFT_LONGITUDE')
-                    lim2 = read.lbl_keyword(lbl_filename, 
-                                            'STOP_SUB_SPACECRAFT_LONGITUDE')
-                    self.lon_lim[product][name] = [lim1, lim2]
+            for name, types in self.file_types[product].items():
+                if types['lbl']:
+                    tasks.append((product, name, types['lbl']))
+        
+        # Parse only the label files not found in the cache
+        cache = {} if refresh else self.read_label_cache()
+        mtimes = [os.path.getmtime(task[2]) for task in tasks]
+        todo = [lbl_filename for (_, _, lbl_filename), mtime in zip(tasks, mtimes)
+                if lbl_filename not in cache or cache[lbl_filename]['mtime'] != mtime]
+        
+        with ThreadPoolExecutor(max_workers=n_jobs) as ex:
+            parsed = dict(zip(todo, ex.map(self._parse_one_lbl, todo)))
+        
+        rows = []
+        for (product, name, lbl_filename), mtime in zip(tasks, mtimes):
+            if lbl_filename in parsed:
+                clock, epoch, lat, lon = parsed[lbl_filename]
+            else:
+                row = cache[lbl_filename]
+                clock = [row['start_time'], row['stop_time']]
+                epoch = [row['start_epoch'], row['stop_epoch']]
+                lat = [row['start_lat'], row['stop_lat']]
+                lon = [row['start_lon'], row['stop_lon']]
+            self.clock_lim[product][name] = clock
+            self.epoch_lim[product][name] = epoch
+            self.lat_lim[product][name] = lat
+            self.lon_lim[product][name] = lon
+            rows.append({'product':product, 'name':name, 'lbl':lbl_filename, 
+                         'mtime':mtime, 
+                         'start_time':clock[0], 'stop_time':clock[1],
+                         'start_epoch':epoch[0], 'stop_epoch':epoch[1],
+                         'start_lat':lat[0], 'stop_lat':lat[1],
+                         'start_lon':lon[0], 'stop_lon':lon[1]})
+        
+        if rows and (todo or len(rows) != len(cache)):
+            try:
+                pd.DataFrame(rows).to_csv(self.label_cache, header=True, index=False)
+            except OSError:
+                logging.warning('Label cache could not be written to ' + self.label_cache)
+        
+        self.index_epochs()
+        self.index_tracks()
+        
+        
+    def read_label_cache(self):
+        """ Read the label cache file
+        
+        RETURN
+        ------
+        dict {lbl_filename: {column: value}}
+        """
+        if not os.path.exists(self.label_cache):
+            return {}
+        str_columns = ['product', 'name', 'lbl', 'start_time', 'stop_time']
+        try:
+            df = pd.read_csv(self.label_cache, dtype={col:str for col in str_columns}, 
+                             float_precision='round_trip')
+            return df.set_index('lbl').to_dict(orient='index')
+        except (OSError, ValueError, KeyError, pd.errors.EmptyDataError):
+            # Corrupt or partial cache: the labels are parsed again
+            logging.warning('Label cache could not be read from ' + self.label_cache)
+            return {}
+        
+        
+    def index_epochs(self):
+        """ Store the epoch limits as arrays sorted by start epoch for track 
+        matching. Also flag products whose tracks do not overlap in time, 
+        for which a track can be found by binary search
+        """
+        for product in self.epoch_lim.keys():
+            names = list(self.epoch_lim[product].keys())
+            epochs = np.array([self.epoch_lim[product][name] for name in names], 
+                              dtype=np.float64).reshape(-1, 2)
+            order = np.argsort(epochs[:,0], kind='stable')
+            starts, stops = epochs[order,0], epochs[order,1]
+            disjoint = bool(np.all(stops[:-1] < starts[1:]))
+            self._epoch_arr[product] = (starts, stops, np.array(names)[order], 
+                                        disjoint)
+                
+                
+    def index_tracks(self):
+        """ Store the track limits in a table (one row per track), with the 
+        latitude range covered by each track for vectorized region queries
+        """
+        rows = [(product, name, *self.lat_lim[product][name], 
+                 *self.lon_lim[product][name])
+                for product in self.lat_lim.keys() 
+                for name in self.lat_lim[product].keys()]
+        self.tracks = pd.DataFrame(rows, columns=['product', 'name', 'lat0', 
+                                                  'lat1', 'lon0', 'lon1'])
+        lats = self.tracks[['lat0', 'lat1']].to_numpy(dtype=np.float64)
+        lons = self.tracks[['lon0', 'lon1']].to_numpy(dtype=np.float64)
+        self.tracks['latmin'], self.tracks['latmax'] = self.track_lat_range(lats, lons)
+        self.tracks['lonstart'], self.tracks['lonwidth'] = self.track_lon_range(lats, lons)
                 
                 
-    def orig_data(self, product, name):
+    def orig_data(self, product, name, lazy=False):
         """ Read orig data
         
         ARGUMENT
@@ -262,24 +697,34 @@ class Env:
             product full name or substring (e.g., sar05)
         name: string
             file identifier (e.g., '20071221033918')
+        lazy: binary
+            If True, IMG is memory-mapped and IMG_pdb is converted to power 
+            only for the slices taken from it
             
         RETURN
         ------
-        
+        dict of the header columns, IMG, IMG_pdb, Pmax and Pmin. With 
+        lazy=True, IMG is a read-only memory map
         """
         product = self.product_match(product)
-        files = self.files[product][name]
-        lbl_filename = [file for file in files if '.lbl' in file][0]
-        img_filename = [file for file in files if '.img' in file][0]
+        types = self.file_types[product][name]
+        lbl_filename = types['lbl']
+        img_filename = types['img']
         if img_filename and lbl_filename:
-            anc, img = read.img(img_filename, lbl_filename)
+            if lazy:
+                anc, img = _read_img(img_filename, lbl_filename, 
+                                     _mtimes([img_filename, lbl_filename]))
+            else:
+                anc, img = read.img(img_filename, lbl_filename)
             out = anc.to_dict(orient='list')
             out.update({'IMG':img})
             # Gain Correction    
-            line = read.lbl_keyword(lbl_filename, 'Pmax', fullline=True)
-            Pmax = float(line.split(' P')[1][:-1].split(' = ')[-1])
-            Pmin = float(line.split(' P')[2][:-1].split(' = ')[-1])
-            pdb = (255-img)*(Pmax-Pmin)/255+Pmin
+            Pmax, Pmin = self.gain(product, name)
+            if lazy:
+                out.update({'Pmax':Pmax, 'Pmin':Pmin, 
+                            'IMG_pdb':_PowerImage(img, Pmax, Pmin)})
+                return out
+            pdb = _power(img, Pmax, Pmin)
             out.update({'Pmax':Pmax})
             out.update({'Pmin':Pmin})
             out.update({'IMG_pdb':pdb})
@@ -304,22 +749,26 @@ class Env:
         RETURN
         ------
         
+        """
+        df = self._anc_df(product, name)
+        if df is not None:
+            return df.to_dict(orient='list')
+   
+    
+    def _anc_df(self, product, name):
+        """ Read anc data as a DataFrame. Reads are cached, so that repeated
+        requests for the same track do not parse the csv files again
         """
         product = self.product_match(product)
         if product == 'sln-l-lrs-5-sndr-ss-nfoc-power-v1.0':
             product = 'sln-l-lrs-5-sndr-ss-high-v2.0'
-        files = self.files[product][name]
-        anc_filenames = [file for file in files if os.path.join('anc','') in file]
+        anc_filenames = self.file_types[product][name]['anc']
         
         if anc_filenames:
-            out = pd.DataFrame()
-            for anc_filename in anc_filenames:
-                df = pd.read_csv(anc_filename)
-                out = pd.concat([out, df], axis=1)
-            return out.to_dict(orient='list')
+            return _read_csvs(tuple(anc_filenames), _mtimes(anc_filenames))
         else:
             logging.warning('No anc data for ' + product + ' ' + name)
-   
+        
         
     def srf_data(self, product, name, method='mouginot2010'):
         """ Read srf data. It concatenates all columns from the files
@@ -335,18 +784,22 @@ class Env:
         RETURN
         ------
         
+        """
+        df = self._srf_df(product, name, method=method)
+        if df is not None:
+            return df.to_dict(orient='list')
+    
+    
+    def _srf_df(self, product, name, method='mouginot2010'):
+        """ Read srf data as a DataFrame. Reads are cached, so that repeated
+        requests for the same track do not parse the csv files again
         """
         product = self.product_match(product)
-        _files = self.files[product][name]
-        files = [file for file in _files if method in file]
-        anc_filenames = [file for file in files if os.path.join('srf','') in file]
+        anc_filenames = [file for file in self.file_types[product][name]['srf'] 
+                         if method in file]
         
         if anc_filenames:
-            out = pd.DataFrame()
-            for anc_filename in anc_filenames:
-                df = pd.read_csv(anc_filename)
-                out = pd.concat([out, df], axis=1)
-            return out.to_dict(orient='list')
+            return _read_csvs(tuple(anc_filenames), _mtimes(anc_filenames))
         else:
             logging.warning('No srf data for ' + product + ' ' + name)
    
@@ -366,9 +819,8 @@ class Env:
         
         """
         product = self.product_match(product)
-        _files = self.files[product][name]
-        files = [file for file in _files if method in file]
-        sim_filenames = [file for file in files if os.path.join('sim','') in file]
+        sim_filenames = [file for file in self.file_types[product][name]['sim'] 
+                         if method in file]
         
         if sim_filenames:
             if product == 'sln-l-lrs-5-sndr-ss-nfoc-power-v1.0':
@@ -377,7 +829,11 @@ class Env:
                 orig_product = product
             out = self.orig_data(orig_product, name)
             # Replace with simulation files 
-            out['IMG_pdb'] = np.loadtxt(sim_filenames[0], delimiter=",", dtype='float')
+            if sim_filenames[0].endswith('.npy'):
+                out['IMG_pdb'] = np.load(sim_filenames[0]).astype(np.float32, copy=False)
+            else:
+                out['IMG_pdb'] = pd.read_csv(sim_filenames[0], sep=',', header=0, 
+                                             dtype=np.float32, engine='c').to_numpy()
             return out
         else:
             logging.warning(f'No sim data for {product} {name} {method}')
@@ -399,12 +855,17 @@ class Env:
         ------
             Name of the matching track from product2
         """
-        time1s = self.epoch_lim[product1][name1]
-        for name2 in self.epoch_lim[product2]:
-            #logging.info(name2)
-            time2s = self.epoch_lim[product2][name2]
-            if (time2s[0] <= time1s[0] <= time2s[1]) or (time2s[0] <= time1s[1] <= time2s[1]):
-                return name2
+        t1s, t1e = self.epoch_lim[product1][name1]
+        s, e, names, disjoint = self._epoch_arr[product2]
+        if disjoint:
+            for t in (t1s, t1e):
+                i = np.searchsorted(s, t, side='right') - 1
+                if i >= 0 and t <= e[i]:
+                    return names[i]
+            return None
+        mask = ((s <= t1s) & (t1s <= e)) | ((s <= t1e) & (t1e <= e))
+        if mask.any():
+            return names[mask][0]
     
     
     def tracks_intersecting_latlon_box(self, boxlats, boxlons, sampling=10e3,
@@ -430,55 +891,122 @@ class Env:
         tuple{'lats', 'lons'}
         
         """
-        # Create a square
-        box = [(boxlons[0], boxlats[0]), 
-               (boxlons[0], boxlats[1]), 
-               (boxlons[1], boxlats[1]), 
-               (boxlons[1], boxlats[0])
-               ]
-        poly = Polygon(box)
+        # Box boundaries
+        latmin, latmax = np.min(boxlats), np.max(boxlats)
+        lonmin, lonmax = np.min(boxlons), np.max(boxlons)
 
-        products = copy.deepcopy(self.index_products())
-        
-        # Remove nfoc if present
-        try:
-            products.remove('sln-l-lrs-5-sndr-ss-nfoc-power-v1.0')
-        except:
-            pass
-        
+        # Remove nfoc if present. Skip tracks whose latitude or longitude 
+        # range cannot reach the box
+        tracks = self.tracks
+        inlon = self.overlap_lon_range(tracks['lonstart'].to_numpy(), 
+                                       tracks['lonwidth'].to_numpy(), 
+                                       lonmin, lonmax)
+        tracks = tracks[(tracks['product'] != 'sln-l-lrs-5-sndr-ss-nfoc-power-v1.0') & 
+                        (tracks['latmax'] >= latmin) & (tracks['latmin'] <= latmax) &
+                        inlon]
+        
+        # Interpolate the remaining tracks all at once
         out = []
-        
-        for product in products:
-            for track in self.files[product].keys():
-                coord = tools.intermediate_latlon(self.lat_lim[product][track],
-                                                  self.lon_lim[product][track],
-                                                  sampling=sampling)
-                # Test if a point is within the latlon box
-                inbox = [Point(coord['lons'][j], coord['lats'][j]).within(poly) 
-                         for j in np.arange(len(coord['lats']))]
-                if True in inbox:
-                    out = out + [[product, track]]
+        if len(tracks):
+            coords = tools.intermediate_latlons(tracks[['lat0', 'lat1']].to_numpy(), 
+                                                tracks[['lon0', 'lon1']].to_numpy(), 
+                                                sampling=sampling)
+            # Test all points at once, then reduce to one flag per track
+            lons, lats = coords['lons'], coords['lats']
+            inbox = (lons >= lonmin) & (lons <= lonmax) & \
+                    (lats >= latmin) & (lats <= latmax)
+            hits = np.logical_or.reduceat(inbox, coords['starts'])
+            out = [[product, track] for product, track, hit in 
+                   zip(tracks['product'], tracks['name'], hits) if hit]
                     
         if download:
-            for track in out:
-                product = track[0]
-                name = track[1]
-                print(f'Downloading {track}')
-                
-                mkdir_cmd = f'mkdir -p {self.orig_path}{product}/{name[0:8]}'
-                os.system(mkdir_cmd)
-                
-                lftp_cmd = f'lftp -c "open https://data.darts.isas.jaxa.jp/pub/pds3/{product}/{name[0:8]}/;' \
-                + f'mirror -c -P 10 --only-missing -I \'*{name}*\' ' \
-                + f'data {self.orig_path}{product}/{name[0:8]}/" '
-
-                os.system(lftp_cmd)
+            tasks = [(product, name, typ) for product, name in out 
+                     for typ in ['lbl', 'img']]
+            _ = self.download_many(tasks)
         
         return out
         
         
+    def track_lat_range(self, lats, lons):
+        """ Latitude range covered by the great circles between the end 
+        points of tracks. The range includes the highest (or lowest) latitude
+        of the great circle when a track goes through it
+        
+        ARGUMENTS
+        ---------
+        lats: array (n, 2)
+            first and last latitudes of the tracks
+        lons: array (n, 2)
+            first and last longitudes of the tracks
+        
+        RETURN
+        ------
+        latmin, latmax: arrays
+        """
+        az12, az21, _ = _MOON_GEOD.inv(lons[:,0], lats[:,0], lons[:,1], lats[:,1])
+        
+        # Latitude of the great circle vertex (Clairaut's relation)
+        vertex = np.degrees(np.arccos(np.clip(
+            np.abs(np.sin(np.radians(az12))) * np.cos(np.radians(lats[:,0])), 0, 1)))
+        # The track reaches the vertex if it heads poleward at its start and 
+        # equatorward at its end
+        north = (np.cos(np.radians(az12)) > 0) & (np.cos(np.radians(az21)) > 0)
+        south = (np.cos(np.radians(az12)) < 0) & (np.cos(np.radians(az21)) < 0)
+        
+        latmin = np.where(south, -vertex, np.min(lats, axis=1))
+        latmax = np.where(north, vertex, np.max(lats, axis=1))
+        return latmin, latmax
+        
+        
+    def track_lon_range(self, lats, lons):
+        """ Longitude range covered by the great circles between the end 
+        points of tracks, as an eastward interval from a start longitude. 
+        Longitudes vary monotonically along a great circle arc, unless it 
+        goes through a pole where the range is undefined (NaN)
+        
+        ARGUMENTS
+        ---------
+        lats: array (n, 2)
+            first and last latitudes of the tracks
+        lons: array (n, 2)
+            first and last longitudes of the tracks
+        
+        RETURN
+        ------
+        start [0-360], width [deg]: arrays
+        """
+        az12, _, _ = _MOON_GEOD.inv(lons[:,0], lats[:,0], lons[:,1], lats[:,1])
+        east = np.sin(np.radians(az12)) >= 0
+        start = np.where(east, lons[:,0], lons[:,1]) % 360
+        width = np.where(east, lons[:,1]-lons[:,0], lons[:,0]-lons[:,1]) % 360
+        
+        latmin, latmax = self.track_lat_range(lats, lons)
+        polar = (latmax > 90 - 1e-6) | (latmin < -90 + 1e-6)
+        start[polar] = np.nan
+        width[polar] = np.nan
+        return start, width
+    
+    
+    def overlap_lon_range(self, start, width, lonmin, lonmax, tol=1e-6):
+        """ Whether eastward longitude intervals overlap [lonmin, lonmax], 
+        whatever the longitude convention. Undefined (NaN) intervals overlap
+        
+        RETURN
+        ------
+        Binary vector
+        """
+        if lonmax - lonmin >= 360:
+            return np.ones(len(start), dtype=bool)
+        boxstart = lonmin % 360
+        boxwidth = lonmax - lonmin
+        out = ((boxstart - start) % 360 <= width + tol) | \
+              ((start - boxstart) % 360 <= boxwidth + tol) | \
+              ((start - boxstart) % 360 >= 360 - tol)
+        return out | np.isnan(start)
+        
+        
     def run(self, process, product, name, source='orig', archive=True, delete=False, method=None,
-            non_standard_archive_path=None, **kwargs):
+            non_standard_archive_path=None, strict=False, **kwargs):
         """ Run a process
         
         ARGUMENT
@@ -497,12 +1025,23 @@ class Env:
             Force archive if file already exist
         non_standard_archive_path: string
             The archive path name if you do not wish to archive in the standard hierarchy
+        strict: binary
+            Whether exceptions raised by the process propagate. Otherwise, 
+            they are logged with their traceback and an empty result is 
+            returned (e.g., to go on with run_all)
             
         RETURN
         ------
         results
         
         """
+        try:
+            fn, default_method, extension, _ = self._processes[process]
+        except KeyError:
+            raise ValueError(f'Unknown process {process}')
+        if not method:
+            method = default_method
+        
         # GET DATA
         # --------
         product = self.product_match(product)
@@ -516,20 +1055,15 @@ class Env:
         # ------------
         
         if process == 'anc':
-            archive_path = os.path.join(self.xtra_path, process, product, name[:8] ,'data')
-            filename = self.filename_root(product, name) + '_orig.txt'
-            
-        if process == 'srf':
-            if not 'method':
-                method = 'mouginot2010'
-            archive_path = os.path.join(self.xtra_path, process, product, name[:8] ,'data')
-            filename = self.filename_root(product, name) + f'_{method}.txt'
-        
-        if process == 'sgy':
-            if source == 'sim':
-                source = method
-            archive_path = os.path.join(self.xtra_path, process, product, name[:8] ,'data')
-            filename = self.filename_root(product, name) + f'_{source}.sgy'
+            suffix = 'orig'
+        elif process == 'srf':
+            suffix = method
+        elif source == 'sim':
+            suffix = method
+        else:
+            suffix = source
+        archive_path = os.path.join(self.xtra_path, process, product, name[:8] ,'data')
+        filename = self.filename_root(product, name) + f'_{suffix}{extension}'
             
         if non_standard_archive_path:
             archive_path = non_standard_archive_path
@@ -540,15 +1074,17 @@ class Env:
         #------------
         
         try:
-            result = getattr(processing, process)(data, method=method, **kwargs)
-        except:
-            logging.warning(f'Exception for {process} {product} {name}')
+            result = fn(data, method=method, **kwargs)
+        except Exception:
+            if strict:
+                raise
+            logging.exception(f'Exception for {process} {product} {name}')
             result = []
         else:
             # ARCHIVE
             #--------
             if archive:
-                if not glob.glob(archive_fullname) or delete:
+                if not os.path.exists(archive_fullname) or delete:
                     os.makedirs(archive_path, exist_ok=True)
                     if process == 'sgy':
                         result.write(archive_fullname, format='SEGY', data_encoding=5)  # encode 1 for IBM, 5 for IEEE
@@ -560,23 +1096,31 @@ class Env:
         
         
     def run_all(self, process, product, delete=False, archive=True,
-                n_jobs=4, verbose=6, **kwargs):
+                n_jobs=4, verbose=6, prefer=None, **kwargs):
         """ Run a process on all tracks/names within a product
+        
+        ARGUMENTS
+        ---------
+        prefer: string ('processes' or 'threads')
+            joblib backend preference. By default, threads for the I/O-bound 
+            processes (anc, sgy), which avoids pickling the Class for each 
+            task, and processes for the CPU-bound ones (srf)
         """
-        logging.warning('Logging does not work with joblib.Parallel')
+        if process not in self._processes:
+            raise ValueError(f'Unknown process {process}')
+        if prefer is None:
+            prefer = self._processes[process][3]
+        if prefer != 'threads':
+            logging.warning('Logging does not work with joblib.Parallel processes')
         product = self.product_match(product)
         names = self.files[product].keys()
         
-        results = Parallel(n_jobs=n_jobs, verbose=verbose)(
-            delayed(self.run)(process, product, name, **{'archive':archive ,
-                                                       'delete':delete, 
-                                                       #'method':method,
-                                                       }, **kwargs) 
+        results = Parallel(n_jobs=n_jobs, verbose=verbose, prefer=prefer)(
+            delayed(self.run)(process, product, name, archive=archive, 
+                              delete=delete, **kwargs) 
             for name in names)
         
-        #for name in names:
-        #    _ = self.run(process, product, name, 
-        #             archive=archive, delete=delete, **kwargs)
+        return results
 
             
     def plt_rdg(self, product, name, sim=False, ax=None, latlim=None,
@@ -618,18 +1162,24 @@ class Env:
             img = self.sim_data(product, name)
         else:
             img = self.orig_data(product, name)['IMG_pdb']
-        anc = self.anc_data(product, name)
+        anc = self._anc_df(product, name)
         #xlim = np.sort((np.where(anc['latitude'] <= latlim[0])[0][0], 
         #                np.where(anc['latitude'] <= latlim[1])[0][0]))
-        latitude = np.array(anc['latitude'])
+        latitude = anc['latitude'].to_numpy()
         if not latlim:
             latlim = [latitude[0], latitude[-1]]
-        idx = self.wherelat(product, name, latlim)
-    
-        #idx = (latitude >= np.min(latlim)) & (
-        #       latitude <= np.max(latlim))
-        id1 = (np.where(idx)[0])[0]
-        id2 = (np.where(idx)[0])[-1]
+        # Valid bins, found once from the track's anc latitudes (as wherelat)
+        lat_slice = self.lat_slice(product, name, latlim)
+        if lat_slice is not None:
+            idx = np.zeros(len(latitude), dtype=bool)
+            idx[lat_slice] = True
+            id1, id2 = lat_slice.start, lat_slice.stop - 1
+        else:
+            idx = (latitude >= np.min(latlim)) & (latitude <= np.max(latlim))
+            bins = np.flatnonzero(idx)
+            id1, id2 = (bins[0], bins[-1]) if bins.size else (0, -1)
+        if id2 < id1:
+            raise ValueError(f'No bin of {product} {name} within latitudes {latlim}')
         #img = self.orig_data(product, name)['IMG'][:,xlim[0]:xlim[1]]
     
         # Plot
@@ -654,6 +1204,23 @@ class Env:
         return img, idx
 
     
+    def gain(self, product, name):
+        """ Gain coefficients used to convert the orig LRS signal to power.
+        They are read once from the lbl file, then cached in the Class
+        
+        RETURN
+        ------
+        Pmax, Pmin
+        """
+        cal = self._cal.setdefault(product, {})
+        if name not in cal:
+            lbl_filename = self.file_types[product][name]['lbl']
+            if not lbl_filename:
+                raise IndexError('No lbl file for ' + product + ' ' + name)
+            cal[name] = read.lbl_gain(lbl_filename)
+        return cal[name]
+    
+    
     def signalconversion(self, product, name, dn, calval=0):
         """ !!! DEPRECATED !!! 
         Convert the orig LRS signal to power. Note that the coefficients 
@@ -668,25 +1235,21 @@ class Env:
             Calibration value in dB
         """
         
-        # Find lbl file name
-        files = self.files[product][name]
+        # Get Conversion coefficients 
         try:
-            lbl_filename = [file for file in files if '.lbl' in file][0]
+            Pmax, Pmin = self.gain(product, name)
         except IndexError:
             logging.warning('No orig data for ' + product + ' ' + name)
-        
-        # Get Conversion coefficients 
-        line = read.lbl_keyword(lbl_filename, 'Pmax', fullline=True)
-        Pmax = float(line.split(' P')[1][:-1].split(' = ')[-1])
-        Pmin = float(line.split(' P')[2][:-1].split(' = ')[-1])
+            return None
         
         # Conversion
-        pdb = (255-dn)*(Pmax-Pmin)/255+Pmin
-        out = pdb
+        out = np.subtract(np.float32(255), dn, dtype=np.float32)
+        out *= np.float32((Pmax-Pmin)/255)
+        out += np.float32(Pmin)
         return out
         
         
-    def wherelat(self, product, name, lim):
+    def wherelat(self, product, name, lim, vec=None):
         """ return a binary vector indicating where latitudes 
         are within the indicated limits
     
@@ -694,18 +1257,74 @@ class Env:
         ---------
         lim: [float, float]
             latitude limits
+        vec: array
+            latitudes of the track (read from anc data if not given)
         
         RETURN
         ------
         Binary vector
         """
-        anc = self.anc_data(product, name)
-        vec = np.array(anc['latitude'])
-        out = (vec >= np.min(lim)) & (vec <= np.max(lim))
+        lat_slice = self.lat_slice(product, name, lim, vec=vec)
+        if vec is None:
+            vec = self._anc_df(product, name)['latitude'].to_numpy()
+        if lat_slice is not None:
+            out = np.zeros(len(vec), dtype=bool)
+            out[lat_slice] = True
+        else:
+            out = (vec >= np.min(lim)) & (vec <= np.max(lim))
         
         return out
         
         
+    def lat_slice(self, product, name, lim, vec=None):
+        """ return the slice of bins where latitudes are within the 
+        indicated limits, found by binary search. Only for tracks with 
+        monotonic latitudes.
+    
+        ARGUMENTS
+        ---------
+        lim: [float, float]
+            latitude limits
+        vec: array
+            latitudes of the track (read from anc data if not given)
+        
+        RETURN
+        ------
+        slice, or None if latitudes are not monotonic
+        """
+        # The direction is cached for the anc latitudes of the track only
+        key = None
+        if vec is None:
+            product = self.product_match(product)
+            vec = self._anc_df(product, name)['latitude'].to_numpy()
+            key = (product, name)
+        
+        if key in self._lat_monotonic:
+            direction = self._lat_monotonic[key]
+        else:
+            diff = np.diff(vec)
+            if np.all(diff >= 0):
+                direction = 1
+            elif np.all(diff <= 0):
+                direction = -1
+            else:
+                direction = 0
+            if key is not None:
+                self._lat_monotonic[key] = direction
+        
+        if direction == 0:
+            return None
+        
+        n = len(vec)
+        if direction == 1:
+            i1 = np.searchsorted(vec, np.min(lim), side='left')
+            i2 = np.searchsorted(vec, np.max(lim), side='right')
+        else:
+            i1 = n - np.searchsorted(vec[::-1], np.max(lim), side='right')
+            i2 = n - np.searchsorted(vec[::-1], np.min(lim), side='left')
+        return slice(int(i1), int(i2))
+        
+        
     def wherelon(self, product, name, lim):
         """ return a binary vector indicating where longitudes 
         are within the indicated limits
@@ -719,8 +1338,7 @@ class Env:
         ------
         Binary vector
         """
-        anc = self.anc_data(product, name)
-        vec = np.array(anc['longitude'])
+        vec = self._anc_df(product, name)['longitude'].to_numpy()
         out = (vec >= np.min(lim)) & (vec <= np.max(lim))
         
         return out
@@ -742,9 +1360,9 @@ class Env:
         ------
         Binary vector
         """
-        anc = self.anc_data(product, name)
-        vec_lat = np.array(anc['latitude'])
-        vec_lon = np.array(anc['longitude'])
+        anc = self._anc_df(product, name)
+        vec_lat = anc['latitude'].to_numpy()
+        vec_lon = anc['longitude'].to_numpy()
         out = (vec_lat >= np.min(latlim)) & (vec_lat <= np.max(latlim)) & (vec_lon >= np.min(lonlim)) & (vec_lon <= np.max(lonlim))
         
         return out
@@ -753,10 +1371,6 @@ class Env:
     def lonlat2stereo(self, product, name, sampling=1000e3, use_anc=False):
         """ Convert longitude/latitude to xy stereographic
         """
-        crs_lonlat = CRS.from_string("+proj=longlat +R=1737400 +no_defs")
-        crs_stereo = CRS.from_proj4("+proj=stere +lat_0=-90 +lon_0=0 +k=1 +x_0=0 +y_0=0 +R=1737400 +units=m +no_defs +type=crs")
-        transformer = Transformer.from_crs(crs_lonlat, crs_stereo)
-        
         latlim = self.lat_lim[product][name]
         lonlim = self.lon_lim[product][name]
         if not use_anc:
@@ -764,23 +1378,22 @@ class Env:
             lon = geo['lons']
             lat = geo['lats']
         else:
-            anc = self.anc_data(product, name)
-            lon = anc['longitude']
-            lat = anc['latitude']
-        x, y = transformer.transform(lon, lat)
+            anc = self._anc_df(product, name)
+            lon = anc['longitude'].to_numpy()
+            lat = anc['latitude'].to_numpy()
+        lon = np.asarray(lon, dtype=np.float64)
+        lat = np.asarray(lat, dtype=np.float64)
+        x, y = self._stereo_transformer.transform(lon, lat)
         return x, y
    
 
     def distance(self, product, name, sampling=1000e3):
         """ Give distance in meters between first and last points
         """
-        moon_radius = 1737400
-        geod = pyproj.Geod(ellps="sphere", a=moon_radius, b=moon_radius)
-        
         latlim = self.lat_lim[product][name]
         lonlim = self.lon_lim[product][name]
         
-        _, _, forward_distance = geod.inv(lonlim[0], latlim[0], lonlim[1], latlim[1])
+        _, _, forward_distance = _MOON_GEOD.inv(lonlim[0], latlim[0], lonlim[1], latlim[1])
         
         return forward_distance
 
@@ -820,30 +1433,22 @@ class Track():
         # Names
         self.swh['name'] = name
         self.swh_sim['name'] = self.swh['name']
-        self.sar05['name'] = LRS.matching_track(self.swh['product'], 
-                                                self.swh['name'], 
-                                                self.sar05['product'])
-        self.sar10['name'] = LRS.matching_track(self.swh['product'], 
-                                                self.swh['name'], 
-                                                self.sar10['product'])
-        #self.sar40['name'] = LRS.matching_track(self.swh['product'], 
-        #                                        self.swh['name'], 
-        #                                        self.sar40['product'])
+        for data in [self.sar05, self.sar10]:#, self.sar40]:
+            data['name'] = LRS.matching_track(self.swh['product'], 
+                                              self.swh['name'], 
+                                              data['product'])
         self.nfoc_sim['name'] = self.swh['name']
         # Download
         if get_missing == True:
             self.get_missing()
         # Indices
         self.idx = LRS.wherelatlon(self.swh['product'], self.swh['name'], self.latlim, self.lonlim)
-        self.length = len(self.idx[self.idx == True])
+        bins = np.flatnonzero(self.idx)
+        self.length = len(bins)
         # Ancilliary data
         self.anc = LRS.anc_data(self.swh['product'], self.swh['name'])
-        self.latitude = np.array(self.anc['latitude'])[self.idx]
-        self.longitude = np.array(self.anc['longitude'])[self.idx]
-        self.altitude = np.array(self.anc['altitude'])[self.idx]
-        self.range0 = np.array(self.anc['range0'])[self.idx]
-        self.date = np.array(self.anc['date'])[self.idx]
-        self.time = np.array(self.anc['time'])[self.idx]
+        for key in ['latitude', 'longitude', 'altitude', 'range0', 'date', 'time']:
+            setattr(self, key, np.asarray(self.anc[key]).take(bins))
         # Non-swh indices
         self.index()
         # Surface
@@ -866,10 +1471,8 @@ class Track():
         #self.LRS = Env()
         
         # anc processing
-        _ = self.LRS.run('anc', self.swh['product'], self.swh['name'], archive=True)
-        _ = self.LRS.run('anc', self.sar05['product'], self.sar05['name'], archive=True)
-        _ = self.LRS.run('anc', self.sar10['product'], self.sar10['name'], archive=True)
-        #_ = self.LRS.run('anc', self.sar40['product'], self.sar40['name'], archive=True)
+        for data in [self.swh, self.sar05, self.sar10]:#, self.sar40]:
+            _ = self.LRS.run('anc', data['product'], data['name'], archive=True)
         #self.LRS = Env()
         
         # srf processing
@@ -885,52 +1488,42 @@ class Track():
         """Indices within latlim and lonlim for each products
         """
         #idx_binary = self.LRS.wherelat(self.swh['product'], self.swh['name'], self.latlim)
-        idx_binary = self.LRS.wherelatlon(self.swh['product'], self.swh['name'], self.latlim, self.lonlim)
-        self.swh['index'] = np.arange( len(idx_binary) )[idx_binary]
+        # self.idx already holds the swh bins within latlim and lonlim
+        self.swh['index'] = np.flatnonzero(self.idx)
         self.swh_sim['index'] = self.swh['index']
         
-        idx0 = np.where(self.LRS.anc_data(self.sar05['product'], self.sar05['name'])['time'] > self.time[0])[0][0]
-        self.sar05['index'] = np.arange(idx0, idx0+self.length, 1)
-        
-        idx0 = np.where(self.LRS.anc_data(self.sar10['product'], self.sar10['name'])['time'] > self.time[0])[0][0]
-        self.sar10['index'] = np.arange(idx0, idx0+self.length, 1)
-        
-        #idx0 = np.where(self.LRS.anc_data(self.sar40['product'], self.sar40['name'])['time'] > self.time[0])[0][0]
-        #self.sar40['index'] = np.arange(idx0, idx0+self.length, 1)
+        # First bin after the segment start (times increase along a track)
+        for data in [self.sar05, self.sar10]:#, self.sar40]:
+            idx0 = self.first_bin_after(data, self.time[0])
+            data['index'] = np.arange(idx0, idx0+self.length, 1)
         
         self.nfoc_sim['index'] = self.swh['index']
     
     
+    def first_bin_after(self, data, time):
+        """ Index of the first bin of a product track acquired after a time,
+        found by binary search
+        """
+        times = np.asarray(self.LRS.anc_data(data['product'], data['name'])['time'])
+        idx0 = int(np.searchsorted(times, time, side='right'))
+        if idx0 == len(times):
+            raise IndexError(f"No {data['product']} bin after {time}")
+        return idx0
+    
+    
     def surface(self):
         """ Surface echo
         """
-        self.swh['srf'] = {}
-        self.sar05['srf'] = {}
-        self.sar10['srf'] = {}
-        #self.sar40['srf'] = {}
+        for data in [self.swh, self.sar05, self.sar10]:#, self.sar40]:
+            data['srf'] = {}
+        l = len(self.swh['index'])
         for method in ['mouginot2010', 'grima2012']:
-            self.swh['srf'][method] = {}
-            self.sar05['srf'][method] = {}
-            self.sar10['srf'][method] = {}
-            #self.sar40['srf'][method] = {}
-            for n in ['y', 'pdb']:
-                l = len(self.swh['index'])
-                
-                arr = self.LRS.srf_data(self.swh['product'], self.swh['name'], 
-                                        method=method)[n][self.swh['index'][0]:self.swh['index'][0]+l]
-                self.swh['srf'][method][n] = np.array(arr)
-                
-                arr = self.LRS.srf_data(self.sar05['product'], self.sar05['name'], 
-                                        method=method)[n][self.sar05['index'][0]:self.sar05['index'][0]+l]
-                self.sar05['srf'][method][n] = np.array(arr)
-                
-                arr = self.LRS.srf_data(self.sar10['product'], self.sar10['name'], 
-                                        method=method)[n][self.sar10['index'][0]:self.sar10['index'][0]+l]
-                self.sar10['srf'][method][n] = np.array(arr)
-                
-                #arr = self.LRS.srf_data(self.sar40['product'], self.sar40['name'], 
-                #                        method=method)[n][self.sar40['index'][0]:self.sar40['index'][0]+l]
-                #self.sar40['srf'][method][n] = np.array(arr)
+            for data in [self.swh, self.sar05, self.sar10]:#, self.sar40]:
+                # Read each srf file once for all quantities
+                srf = self.LRS.srf_data(data['product'], data['name'], method=method)
+                i0 = data['index'][0]
+                data['srf'][method] = {n: np.array(srf[n][i0:i0+l]) 
+                                       for n in ['y', 'pdb']}
                 
             # Upsampling to match 24m/pixel in range (i.e., same as far)
             self.swh['srf'][method]['y'] = self.swh['srf'][method]['y']*2
@@ -942,19 +1535,19 @@ class Track():
         
         # Get surface picks
         y = self.swh['srf']['mouginot2010']['y']
-        x = np.arange(len(y))
-        
-        f = UnivariateSpline(x, y, s=s)
-        y_smooth = f(x)
         
         y_constant_shift = np.full(len(y), 400-np.mean(y), dtype=int)
         y_constant_shift_sim = np.full(len(y), -900, dtype=int)
-        y_relative_shift = np.array(y_smooth, dtype=int)-200
         
         self.swh['range_shift'] = y_constant_shift
         self.swh_sim['range_shift'] = y_constant_shift_sim
         self.nfoc_sim['range_shift'] = y_constant_shift_sim
         if self.relative_shift:
+            # The smoothed surface is only needed for the relative shift
+            x = np.arange(len(y))
+            f = UnivariateSpline(x, y, s=s)
+            y_smooth = f(x)
+            y_relative_shift = np.array(y_smooth, dtype=int)-200
             self.sar05['range_shift'] = y_constant_shift + y_relative_shift
         else:
             self.sar05['range_shift'] = y_constant_shift
@@ -965,10 +1558,7 @@ class Track():
     def distance(self, vec=False):
         """ Distance between start and end points
         """
-        moon_radius = 1737400
-        geod = pyproj.Geod(a=moon_radius, b=moon_radius)
-        
-        _, _, forward_distance = geod.inv(self.longitude[0], self.latitude[0], 
+        _, _, forward_distance = _MOON_GEOD.inv(self.longitude[0], self.latitude[0], 
                                           self.longitude[-1], self.latitude[-1])
         out = forward_distance
         if vec:
@@ -981,52 +1571,39 @@ class Track():
         """ Radargrams
         """
         l = len(self.swh['index'])
-        rdg = self.LRS.orig_data(self.swh['product'], self.swh['name'])['IMG_pdb']
-        # Upsampling to match 24m/pixel in range (i.e., same as far)
-        rdg = rdg.repeat(2, axis=0)
-        self.swh['rdg'] = rdg[:,self.swh['index'][0]:self.swh['index'][0]+l]
-        
-        rdg = self.LRS.orig_data(self.sar05['product'], self.sar05['name'])['IMG_pdb']
-        self.sar05['rdg'] = rdg[:,self.sar05['index'][0]:self.sar05['index'][0]+l]
-        
-        rdg = self.LRS.orig_data(self.sar10['product'], self.sar10['name'])['IMG_pdb']
-        self.sar10['rdg'] = rdg[:,self.sar10['index'][0]:self.sar10['index'][0]+l]
-        
-        #rdg = self.LRS.orig_data(self.sar40['product'], self.sar40['name'])['IMG_pdb']
-        #self.sar40['rdg'] = rdg[:,self.sar40['index'][0]:self.sar40['index'][0]+l]
-        
-        try: # No swh simulation avaialble
-            rdg = self.LRS.sim_data(self.swh_sim['product'], self.swh_sim['name'])
-            self.swh_sim['rdg'] = rdg[:,self.swh_sim['index'][0]:self.swh_sim['index'][0]+l]
-        except:
-            self.swh_sim['rdg'] = self.swh['rdg']*0-255
-        
-        try: # No nfoc simulation avaialble
-            rdg = self.LRS.sim_data(self.nfoc_sim['product'], self.nfoc_sim['name'])
-            self.nfoc_sim['rdg'] = rdg[:,self.nfoc_sim['index'][0]:self.nfoc_sim['index'][0]+l]
-        except:
-            self.nfoc_sim['rdg'] = self.swh['rdg']*0-255
-        
-        # Shift radargrams
-        for i in np.arange(l):
-            try:
-                self.swh['rdg'][:, i] = np.roll(self.swh['rdg'][:, i], self.swh['range_shift'][i])
-                self.swh_sim['rdg'][:, i] = np.roll(self.swh_sim['rdg'][:, i], self.swh_sim['range_shift'][i])
-                self.nfoc_sim['rdg'][:, i] = np.roll(self.nfoc_sim['rdg'][:, i], self.nfoc_sim['range_shift'][i])
-                self.sar05['rdg'][:, i] = np.roll(self.sar05['rdg'][:, i], self.sar05['range_shift'][i])
-                self.sar10['rdg'][:, i] = np.roll(self.sar10['rdg'][:, i], self.sar10['range_shift'][i])
-                #self.sar40['rdg'][:, i] = np.roll(self.sar40['rdg'][:, i], self.sar40['range_shift'][i])
+        for data in [self.swh, self.sar05, self.sar10]:#, self.sar40]:
+            # Only the columns of the segment are read from disk. They are 
+            # upsampled and shifted as 8-bit samples, then converted to power
+            orig = self.LRS.orig_data(data['product'], data['name'], lazy=True)
+            window = orig['IMG'][:,data['index'][0]:data['index'][0]+l]
+            if data is self.swh:
+                # Upsampling to match 24m/pixel in range (i.e., same as far),
+                # written from disk straight into the upsampled array
+                dn = np.empty((2*window.shape[0], window.shape[1]), dtype=window.dtype)
+                dn[0::2] = window
+                dn[1::2] = window
+            else:
+                dn = np.array(window)
+            _roll_columns(dn, data['range_shift'])
+            data['rdg'] = _power(dn, orig['Pmax'], orig['Pmin'])
+        
+        for data in [self.swh_sim, self.nfoc_sim]:
+            try: # No simulation avaialble
+                rdg = self.LRS.sim_data(data['product'], data['name'])
+                data['rdg'] = rdg[:,data['index'][0]:data['index'][0]+l]
             except:
-                pass
+                data['rdg'] = np.full_like(self.swh['rdg'], -255)
+            # Shift radargrams
+            _roll_columns(data['rdg'], data['range_shift'])
     
     
     def stereo(self, crs_lonlat = '+proj=longlat +R=1737400 +no_defs',
               crs_stereo = '+proj=stere +lat_0=-90 +lon_0=0 +k=1 +x_0=0 +y_0=0 +R=1737400 +units=m +no_defs +type=crs'):
         """ Convert longitude/latitude to xy stereographic
         """
-        transformer = Transformer.from_crs(CRS.from_string(crs_lonlat), 
-                                           CRS.from_proj4(crs_stereo))
-        x, y = transformer.transform(self.longitude, self.latitude)
+        transformer = _transformer(crs_lonlat, crs_stereo)
+        x, y = transformer.transform(np.asarray(self.longitude, dtype=np.float64), 
+                                     np.asarray(self.latitude, dtype=np.float64))
         return np.array(x), np.array(y)#{'x':x, 'y':y}
     
     
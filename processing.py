@@ -4,11 +4,15 @@ import subradar as sr
 from obspy.core import AttribDict, Stats, Trace, Stream
 from obspy.io.segy.segy import SEGYBinaryFileHeader, SEGYTraceHeader
 import scipy.io
+import copy
 from pyproj import CRS, Transformer
 from datetime import datetime
 from . import read
 
 
+# Factor converting a power in dB to a linear amplitude with exp()
+_DB_TO_AMP = np.log(10)/20
+
 
 def anc(data, **kwargs):
     """ Create ancilliary data from the headers in the orignal data
@@ -18,42 +22,50 @@ def anc(data, **kwargs):
     data: dict
         Classdef.Env.orig_data()
     """
-    df = pd.DataFrame()
-    df['date'] = [str(date)[2:-1] for date in data['OBSERVATION_TIME']]
-    dates = df['date'].values
+    date = pd.Series(data['OBSERVATION_TIME']).str.decode('ascii')
     
     # Fill empty 'OBSERVATION_TIME' with interpolated value
-    no_date_index = df['date'][df['date'].str.contains(' ')].index.values
-    date_index = df['date'][~df['date'].str.contains(' ', na=False)].index.values
+    no_date_index = date[date.str.contains(' ')].index.values
+    date_index = date[~date.str.contains(' ', na=False)].index.values
     if len(no_date_index) > 0:    
-        dates = df['date'].values
+        dates = date.values
         date_timestamps = [datetime.fromisoformat(date).timestamp() for date in dates[date_index]]
         no_date_timestamps = np.interp(no_date_index, date_index, date_timestamps)
         no_date_dates = [datetime.fromtimestamp(no_date_timestamp).isoformat()[:-3] for no_date_timestamp in no_date_timestamps]
-        df['date'][no_date_index] = no_date_dates
-    
-    df['time'] = [''.join(''.join(''.join(
-                  d.split('.')[0].split('T')).split('-')).split(':')) 
-                  for d in df['date']]
-    df['delay'] = data['DELAY']
-    df['latitude'] = data['SUB_SPACECRAFT_LATITUDE']
-    df['longitude'] = data['SUB_SPACECRAFT_LONGITUDE']
-    df['altitude'] = data['SPACECRAFT_ALTITUDE']
-    df['pmax'] = data['Pmax']
-    df['pmin'] = data['Pmin']
+        date[no_date_index] = no_date_dates
+    
+    cols = {}
+    cols['date'] = date
+    cols['time'] = date.str.split('.').str[0].str.replace('[-T:]', '', regex=True)
+    cols['delay'] = data['DELAY']
+    cols['latitude'] = data['SUB_SPACECRAFT_LATITUDE']
+    cols['longitude'] = data['SUB_SPACECRAFT_LONGITUDE']
+    cols['altitude'] = data['SPACECRAFT_ALTITUDE']
+    cols['pmax'] = data['Pmax']
+    cols['pmin'] = data['Pmin']
     if 'DISTANCE_TO_RANGE0' in data.keys():
-        df['range0'] = data['DISTANCE_TO_RANGE0']
+        cols['range0'] = data['DISTANCE_TO_RANGE0']
     else:
-        df['range0'] = np.zeros(len(data['OBSERVATION_TIME']))
+        cols['range0'] = np.zeros(len(data['OBSERVATION_TIME']))
+    df = pd.DataFrame(cols)
         
     # Get data from kernels
     kernels = read.spice_kernels(list(df['date']))
-    for key in kernels.keys():
-        df[key] = kernels[key]
+    if kernels is None:
+        # Do not archive an anc without the kernel columns
+        raise RuntimeError('SPICE kernels not found, anc not created')
+    df = pd.concat([df, pd.DataFrame(kernels, index=df.index)], axis=1)
         
     return df
 
 
+def _db_to_amp(pdb):
+    """ Convert a power in dB to a linear amplitude, in a single new array
+    """
+    amp = np.multiply(pdb, _DB_TO_AMP)
+    return np.exp(amp, out=amp)
+
+
 def srf(data, method='mouginot2010', **kwargs):
     """ Create surface data from the headers in the orignal data
     
@@ -70,40 +82,71 @@ def srf(data, method='mouginot2010', **kwargs):
     ------
     Dictionary of coordinate (y), power in dB (pdb), and linear amplitude (amp)
     """
-    df = pd.DataFrame()
-    
     # Data
-    img = np.array(data['IMG_pdb'])
+    img = np.asarray(data['IMG_pdb'])
     
     # surface estimate
-    y_size = np.shape(img)[1]
-    ymax = [np.argmax(img[:,i]) for i in np.arange(y_size)]
-    y_estimate = np.mean(ymax)
+    ymax = np.argmax(img, axis=0)
+    y_estimate = ymax.mean()
     
-    if method == 'mouginot2010':
-        img_for_detection = 10**(img/20)
-        y0 = np.zeros(np.shape(img)[1])+y_estimate
-        winsize = 300
-        
-    if method == 'grima2012':
-        img_for_detection = 10**(img/20)
-        y0 = np.zeros(np.shape(img)[1])+y_estimate
+    if method in ['mouginot2010', 'grima2012']:
+        img_for_detection = _db_to_amp(img)
+        y0 = np.full(np.shape(img)[1], y_estimate)
         winsize = 300
         
     y = sr.surface.detector(img_for_detection, axis=1, 
                             y0=y0, winsize=winsize, method=method)
     
-    y = np.flip(y) #surface.detector returns y backwards?
-    y = [int(val) for val in y]
+    y = np.flip(y).astype(np.intp) #surface.detector returns y backwards?
     
-    pdb = [img[val, i] for i, val in enumerate(y)]
-    amp = [10**(val/20) for val in pdb]
+    pdb = img[y, np.arange(y.size)]
+    amp = _db_to_amp(pdb)
     
     df = pd.DataFrame({'y':y, 'pdb':pdb, 'amp':amp})
     
     return df
 
 
+def _sgy_header():
+    """ Segy trace header with the fields common to all traces
+    """
+    header = SEGYTraceHeader()
+    header.scalar_to_be_applied_to_all_coordinates = 1
+    header.coordinate_units = 1 # 1 = length (meters or feet)
+    header.trace_value_measurement_unit = 1 # 1 = length (meters or feet)
+    header.transduction_units = 1 # 1 = length (meters or feet)
+    header.source_measurement_unit = 1 # 1 = length (meters or feet)
+    #header.number_of_samples_in_this_trace = 0 # Done automatically by ObsPy
+    header.sample_interval_in_ms_for_this_trace = 50
+    return header
+
+
+def _sgy_trace(t, i, x, y, elevation, proto):
+    """ Make the ObsPy Trace of the i-th radargram column, with its segy header
+    copied from proto. x, y and elevation are integers
+    """
+    # Trace header
+    header = copy.copy(proto)
+    header.trace_sequence_number_within_line = i + 1
+    header.trace_sequence_number_within_segy_file = i + 1
+    header.ensemble_number = i + 1
+    header.receiver_group_elevation = elevation
+    header.source_coordinate_x = x
+    header.source_coordinate_y = y
+    header.group_coordinate_x = x # same as source positions
+    header.group_coordinate_y = y # same as source positions
+    header.x_coordinate_of_ensemble_position_of_this_trace = x # Maybe same as source positions
+    header.y_coordinate_of_ensemble_position_of_this_trace = y # Maybe same as source positions
+    
+    trace = Trace(t) # Make the ObsPy Trace with the data 
+    # Add required data.
+    trace.stats.delta = 0.0015#0.05/1e6
+    trace.stats.starttime = 0  # Not strictly required.
+    trace.stats.segy = {'trace_header': header}
+    
+    return trace
+
+
 def sgy(data, xy_projection='south_stereo', xlim=[-1e7,1e7], ylim=[-1e7,1e7], **kwargs):
     """ Convert data to segy
     xy_projetion is the projection to determine x and y coordinates
@@ -117,47 +160,23 @@ def sgy(data, xy_projection='south_stereo', xlim=[-1e7,1e7], ylim=[-1e7,1e7], **
         transformer = Transformer.from_crs(CRS.from_string(crs_lonlat), 
                                             CRS.from_proj4(crs_stereo))
     
-    # Make a new Stream object, basically an empty list-like thing.
-    out = Stream()
-    
-    # Rotate radargram for processing
-    rdg = np.float32(data['IMG_pdb'])
-    rdg = np.flip( np.rot90(rdg), axis=0)
-    
-    # Loop over all trace-like things in the similarity array.
-    for i, t in enumerate(rdg): 
-        x, y = transformer.transform(data['SUB_SPACECRAFT_LONGITUDE'][i], 
-                                     data['SUB_SPACECRAFT_LATITUDE'][i])
-        
-        if (x > xlim[0]) and (x < xlim[1]) and (y > ylim[0]) and (y < ylim[1]): 
-            trace = Trace(t) # Make the ObsPy Trace with the data 
-            # Add required data.
-            trace.stats.delta = 0.0015#0.05/1e6
-            trace.stats.starttime = 0  # Not strictly required.
-            # Add yet more to the header (optional).
-            trace.stats.segy = {'trace_header': SEGYTraceHeader()}
-            trace.stats.segy.trace_header.trace_sequence_number_within_line = i + 1
-            trace.stats.segy.trace_header.trace_sequence_number_within_segy_file = i + 1
-            trace.stats.segy.trace_header.ensemble_number = i + 1
-            trace.stats.segy.trace_header.receiver_group_elevation = int(data['SPACECRAFT_ALTITUDE'][i]*1e3)
-            trace.stats.segy.trace_header.ensemble_number = i + 1
-            trace.stats.segy.trace_header.scalar_to_be_applied_to_all_coordinates = 1
-            trace.stats.segy.trace_header.source_coordinate_x = int(x)
-            trace.stats.segy.trace_header.source_coordinate_y = int(y)
-            trace.stats.segy.trace_header.group_coordinate_x = int(x) # same as source positions
-            trace.stats.segy.trace_header.group_coordinate_y = int(y) # same as source positions
-            trace.stats.segy.trace_header.coordinate_units = 1 # 1 = length (meters or feet)
-            trace.stats.segy.trace_header.trace_value_measurement_unit = 1 # 1 = length (meters or feet)
-            trace.stats.segy.trace_header.transduction_units = 1 # 1 = length (meters or feet)
-            trace.stats.segy.trace_header.source_measurement_unit = 1 # 1 = length (meters or feet)
-            trace.stats.segy.trace_header.sample_interval_in_ms_for_this_trace = 1.6 # ms*10000
-            #trace.stats.segy.number_of_samples_in_this_trace = 0 # Done automatically by ObsPy
-            trace.stats.segy.trace_header.sample_interval_in_ms_for_this_trace = 50
-            trace.stats.segy.trace_header.x_coordinate_of_ensemble_position_of_this_trace = int(x) # Maybe same as source positions
-            trace.stats.segy.trace_header.y_coordinate_of_ensemble_position_of_this_trace = int(y) # Maybe same as source positions
-        
-            if trace:
-                out.append(trace)               # Append the Trace to the Stream.
+    # Rotate radargram for processing (flip(rot90) is a transpose), with 
+    # contiguous traces
+    rdg = np.ascontiguousarray(np.asarray(data['IMG_pdb']).T, dtype=np.float32)
+    
+    # Project all trace coordinates at once
+    xs, ys = transformer.transform(np.asarray(data['SUB_SPACECRAFT_LONGITUDE']), 
+                                   np.asarray(data['SUB_SPACECRAFT_LATITUDE']))
+    
+    # Build the traces within the limits, then the Stream at once
+    inside = (xs > xlim[0]) & (xs < xlim[1]) & (ys > ylim[0]) & (ys < ylim[1])
+    xs_i = xs.astype(np.int64).tolist()
+    ys_i = ys.astype(np.int64).tolist()
+    elevations = (np.asarray(data['SPACECRAFT_ALTITUDE'])*1e3).astype(np.int64).tolist()
+    proto = _sgy_header()
+    traces = [_sgy_trace(rdg[i], i, xs_i[i], ys_i[i], elevations[i], proto) 
+              for i in np.flatnonzero(inside[:len(rdg)]).tolist()]
+    out = Stream(traces=[trace for trace in traces if trace])
         
     # Textual Header
     header = f"""JAXA/Lunar Radar Sounder (LRS)
@@ -2,9 +2,35 @@ import numpy as np
 import pandas as pd
 import spiceypy as spice
 import os
+import atexit
+import threading
+import re
 import logging
 
 
+# Keyword/value pairs (e.g., 'START_TIME = 2007-12-21T03:39:18') of a lbl file
+_KEYWORD_RE = re.compile(r'^\s*([\w^:]+)\s*=\s*(.*?)\s*$', re.M)
+
+# Gain coefficients (e.g., 'Pmax = 13.2, Pmin = -42.5') in a lbl file
+_GAIN_RE = re.compile(r'P(max|min)\s*=\s*([-+]?\d*\.?\d+(?:[eE][-+]?\d+)?)')
+
+# Kaguya SPICE kernels, relative to the kernels directory
+_KERNELS = [('lsk', 'naif0009.tls'),
+            ('ck', 'SEL_M_ALL_S_V03.BC'),
+            ('spk', 'SEL_M_071020_090610_SGMH_02.BSP'),
+            ('fk', 'SEL_V01.TF'),
+            ('fk', 'moon_080317.tf'),
+            ('pck', 'moon_pa_de421_1900-2050.bpc'),
+            ('pck', 'pck00010.tpc'),
+            ('sclk', 'SEL_M_V01.TSC')]
+
+# Kernels directories already loaded in the session
+_LOADED_KERNELS = set()
+
+# CSPICE is not thread-safe: SPICE calls are serialized
+_SPICE_LOCK = threading.Lock()
+
+
 def lbl_keyword(lbl_filename, keyword, fullline=False):
     """Output a keyword value from a lbl file
     
@@ -21,17 +47,85 @@ def lbl_keyword(lbl_filename, keyword, fullline=False):
     ------
     float
     """
+    return lbl_keywords(lbl_filename, [keyword], fullline=fullline)[keyword]
+
+
+def lbl_keywords(lbl_filename, keywords, fullline=False):
+    """Output several keyword values from a lbl file read in a single pass
+    
+    ARGUMENTS
+    ---------   
+    lbl_filename: string
+        lbl filename
+    keywords: list of string
+        keywords to read
+    fullline: Binary
+        If True, will output the entire lines where a string match is found
+    
+    RETURN
+    ------
+    dict {keyword: value}
+    """
+    values = {}
+    with open (lbl_filename, "r") as myfile:
+        for line in myfile:
+            for keyword in keywords:
+                if keyword in line:
+                    if fullline:
+                        values[keyword] = line
+                    else:
+                        values[keyword] = "".join(line.split()).split('=')[-1].replace('"', '')
+    
+    return {keyword: _typed(value) for keyword, value in values.items()}
+
+
+def lbl_all(lbl_filename):
+    """Output all keyword values from a lbl file, found with a single
+    regular expression scan. When a keyword appears several times, the last 
+    value is kept
+    
+    ARGUMENTS
+    ---------   
+    lbl_filename: string
+        lbl filename
+    
+    RETURN
+    ------
+    dict {keyword: value}
+    """
     with open (lbl_filename, "r") as myfile:
-        lines = myfile.readlines()
+        text = myfile.read()
+    
+    return {keyword: _typed("".join(value.split()).replace('"', '')) 
+            for keyword, value in _KEYWORD_RE.findall(text)}
+
 
-    for line in lines:
-        if keyword in line:
-            if fullline:
-                value = line
-            else:
-                value = "".join(line.split()).split('=')[-1].replace('"', '')
+def lbl_gain(lbl_filename):
+    """Output the gain coefficients from a lbl file, found with a single
+    regular expression scan
+    
+    ARGUMENTS
+    ---------   
+    lbl_filename: string
+        lbl filename
     
-    # Set correct output type
+    RETURN
+    ------
+    Pmax, Pmin
+    """
+    with open (lbl_filename, "r") as myfile:
+        text = myfile.read()
+    
+    values = {}
+    for key, value in _GAIN_RE.findall(text):
+        values.setdefault(key, float(value))
+    
+    return values['max'], values['min']
+
+
+def _typed(value):
+    """Set correct output type of a lbl value
+    """
     try:
         if '.' in value:
             return float(value)
@@ -41,7 +135,7 @@ def lbl_keyword(lbl_filename, keyword, fullline=False):
         return value
 
     
-def img(img_filename, lbl_filename):
+def img(img_filename, lbl_filename, mmap=False):
     """Read a binary LRS file
     
     ARGUMENTS
@@ -50,6 +144,9 @@ def img(img_filename, lbl_filename):
         image filename   
     lbl_filename: string
         lbl filename
+    mmap: binary
+        If True, the image is memory-mapped (read-only) instead of being 
+        read, so that only the slices used are loaded from disk
     
     RETURN
     ------
@@ -60,13 +157,17 @@ def img(img_filename, lbl_filename):
     # METADATA
     #---------
     
-    DATA_SET_ID = lbl_keyword(lbl_filename, 'DATA_SET_ID')
-    RECORD_BYTES = lbl_keyword(lbl_filename, 'RECORD_BYTES')
-    FILE_RECORDS = lbl_keyword(lbl_filename, 'FILE_RECORDS')
-    IMG_LINES = lbl_keyword(lbl_filename, 'LINES')
-    TOTAL_BYTES = RECORD_BYTES*FILE_RECORDS
+    keys = lbl_all(lbl_filename)
+    DATA_SET_ID = keys['DATA_SET_ID']
+    RECORD_BYTES = keys['RECORD_BYTES']
+    FILE_RECORDS = keys['FILE_RECORDS']
+    IMG_LINES = keys['LINES']
     IMG_OFFSET = (FILE_RECORDS - IMG_LINES)*RECORD_BYTES
     
+    # Fail early on label metadata not matching the image file
+    if os.path.getsize(img_filename) < IMG_OFFSET + IMG_LINES*RECORD_BYTES:
+        raise ValueError(f'{img_filename} is smaller than described in {lbl_filename}')
+    
     #-------
     # HEADER
     #-------
@@ -102,12 +203,74 @@ def img(img_filename, lbl_filename):
     # IMAGE
     #------
 
-    img = np.fromfile(img_filename, dtype='B', offset=IMG_OFFSET)
-    img = img.reshape(IMG_LINES, RECORD_BYTES)
+    if mmap:
+        img = np.memmap(img_filename, dtype='B', mode='r', offset=IMG_OFFSET, 
+                        shape=(IMG_LINES, RECORD_BYTES))
+    else:
+        with open(img_filename, 'rb') as f:
+            # The image is read end-to-end: ask the kernel to read ahead
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            img = np.fromfile(f, dtype='B', offset=IMG_OFFSET)
+        img = img.reshape(IMG_LINES, RECORD_BYTES)
     
     return header, img
 
 
+def _m2eul_321(mats):
+    """Euler angles of a stack of rotation matrices for the 3-2-1 axis 
+    sequence, as spice.m2eul(mat, 3, 2, 1) but for all matrices at once
+    
+    ARGUMENTS
+    ---------
+    mats: array (n, 3, 3)
+        rotation matrices
+    
+    RETURN
+    ------
+    angle3, angle2, angle1 [radian]
+    """
+    angle2 = np.arcsin(np.clip(mats[:,2,0], -1, 1))
+    
+    # Gimbal lock (as SPICE, only when exactly degenerate): angle3 is set 
+    # to zero and the rotation goes to angle1
+    locked = np.abs(mats[:,2,0]) >= 1
+    angle3 = np.where(locked, 0, np.arctan2(-mats[:,1,0], mats[:,0,0]))
+    angle1 = np.where(locked, np.arctan2(mats[:,1,2], mats[:,1,1]),
+                      np.arctan2(-mats[:,2,1], mats[:,2,2]))
+    
+    return angle3, angle2, angle1
+
+
+def _load_kernels(kernels_path):
+    """Load the Kaguya SPICE kernels once per session. They stay loaded for
+    the following calls and are cleared at exit
+    
+    ARGUMENTS
+    ---------
+    kernels_path: list of string
+        kernels directory
+    
+    RETURN
+    ------
+    True if the kernels are loaded
+    """
+    key = os.path.abspath(os.path.join(*kernels_path))
+    if key in _LOADED_KERNELS:
+        return True
+    
+    try:
+        for kernel in _KERNELS:
+            spice.furnsh(os.path.join(*kernels_path, *kernel))
+    except Exception:
+        return False
+    
+    if not _LOADED_KERNELS:
+        atexit.register(spice.kclear)
+    _LOADED_KERNELS.add(key)
+    return True
+
+
 def spice_kernels(UTCs, kernels_path = ['..', 'data', 'orig', 'kernels']):
     """Extract data from Kaguya SPICE kernels at a given time.
     Kernel can be downloaded at https://data.darts.isas.jaxa.jp/pub/spice/SELENE/
@@ -121,20 +284,18 @@ def spice_kernels(UTCs, kernels_path = ['..', 'data', 'orig', 'kernels']):
     RETURN
     ------
     S/C position (x, y, z), velocity (vx, vy, vz) and attitude (roll, pitch, yaw) parameters
+    """
+    with _SPICE_LOCK:
+        return _spice_kernels(UTCs, kernels_path)
+
+
+def _spice_kernels(UTCs, kernels_path):
+    """spice_kernels, without the lock
     """    
     # Load Kernels
     # ------------
     
-    try:
-        spice.furnsh(os.path.join(*kernels_path, 'lsk', 'naif0009.tls'))
-        spice.furnsh(os.path.join(*kernels_path, 'ck', 'SEL_M_ALL_S_V03.BC'))
-        spice.furnsh(os.path.join(*kernels_path, 'spk', 'SEL_M_071020_090610_SGMH_02.BSP'))
-        spice.furnsh(os.path.join(*kernels_path, 'fk', 'SEL_V01.TF'))
-        spice.furnsh(os.path.join(*kernels_path, 'fk', 'moon_080317.tf'))
-        spice.furnsh(os.path.join(*kernels_path, 'pck', 'moon_pa_de421_1900-2050.bpc'))
-        spice.furnsh(os.path.join(*kernels_path, 'pck', 'pck00010.tpc'))
-        spice.furnsh(os.path.join(*kernels_path, 'sclk', 'SEL_M_V01.TSC'))
-    except:
+    if not _load_kernels(kernels_path):
         logging.warning('Kernel files were not found')
         return None
 
@@ -169,28 +330,21 @@ def spice_kernels(UTCs, kernels_path = ['..', 'data', 'orig', 'kernels']):
         rotMats = [spice.ckgp(-131000, SCLK, 10, 'MOON_ME')[0] for SCLK in SCLKs]
 
         # Get the body-fixed frame transformation matrix from the reference frame
-        ref2bodyMats = [spice.pxform('MOON_ME', 'SELENE_M_SPACECRAFT', ET) for ET in ETs]
+        ref2bodyMats = np.array([spice.pxform('MOON_ME', 'SELENE_M_SPACECRAFT', ET) for ET in ETs])
 
         # Apply the inverse of the body-fixed frame transformation to get the attitude in the body-fixed frame
-        body_fixed_attitudes = [np.matmul(np.linalg.inv(ref2bodyMats[i]), rotMats[i]) for i in np.arange(len(ETs))]
+        # (the inverse of a rotation matrix is its transpose)
+        body_fixed_attitudes = np.matmul(np.swapaxes(ref2bodyMats, 1, 2), np.array(rotMats))
 
         # Extract the roll, pitch, and yaw angles from the body-fixed attitude matrix
-        attitudes = [spice.m2eul(body_fixed_attitude, 3, 2, 1) for body_fixed_attitude in body_fixed_attitudes]
-
-        roll = [np.rad2deg(euler[0]) for euler in attitudes]
-        pitch = [np.rad2deg(euler[1]) for euler in attitudes]
-        yaw = [np.rad2deg(euler[2]) for euler in attitudes]
+        roll, pitch, yaw = np.degrees(_m2eul_321(body_fixed_attitudes))
+        roll, pitch, yaw = roll.tolist(), pitch.tolist(), yaw.tolist()
         
     except:
         roll = list(np.array(x)*0+555)
         pitch = list(np.array(x)*0+555)
         yaw = list(np.array(x)*0+555)
 
-    # Clean up the kernels
-    # --------------------
-
-    spice.kclear()
-    
     return {'x_moon':x, 'y_moon':y, 'z_moon':z, 
             'vx_moon':vx, 'vy_moon':vy, 'vz_moon':vz,
             'roll':roll, 'pitch':pitch, 'yaw':yaw}
\ No newline at end of file
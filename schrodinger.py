@@ -4,63 +4,172 @@
 
 import numpy as np
 import os
-import lrs
 import matplotlib.pyplot as plt
-import scipy
-import copy
-import pandas as pd
-import glob
+import scipy.io
 import logging
-from . import Classdef, read, tools, processing
+import functools
+import io
+import atexit
+from concurrent.futures import ThreadPoolExecutor, wait
+from joblib import Parallel, delayed
+from . import Classdef
 
 
+# Background writer of the browse figures to disk
+_IO_POOL = ThreadPoolExecutor(max_workers=2)
+_PENDING = set()
 
-def simulation_integration(LRS, mat_filename, archive=False, delete=False):
+# Browse radargram width [pixels] (6/11 of the 16-inch wide figure at 500 dpi)
+# and displayed depth [bins]
+_BROWSE_WIDTH = 16*500*6//11
+_BROWSE_DEPTH = 1000
+
+
+
+def _columns(idx):
+    """ Column indexer for idx, as a slice when the columns are consecutive
+    so that the assignment is a plain strided copy instead of a scatter
+    """
+    idx = np.asarray(idx, dtype=np.intp)
+    if idx.size and np.all(np.diff(idx) == 1):
+        return slice(idx[0], idx[-1] + 1)
+    return idx
+
+
+def _browse_rdg(rdg):
+    """ Crop a radargram to the displayed depth and decimate its columns to
+    the browse figure resolution. The extent keeps the original bin 
+    coordinates for imshow
+    """
+    rdg = np.asarray(rdg)
+    nrows, ncols = rdg.shape
+    step = max(1, ncols//_BROWSE_WIDTH)
+    rdg = rdg[:_BROWSE_DEPTH+1, ::step]
+    extent = (-0.5, ncols - 0.5, rdg.shape[0] - 0.5, -0.5)
+    return rdg, extent
+
+
+@functools.lru_cache(maxsize=4)
+def _background(filename):
+    """ Background map image, decoded once per session
+    """
+    img = plt.imread(filename)
+    img.flags.writeable = False
+    return img
+
+
+def _write(filename, content):
+    """ Write bytes to a file
+    """
+    with open(filename, 'wb') as f:
+        f.write(content)
+    return filename
+
+
+def _written(future):
+    """ Report a background write once done
+    """
+    _PENDING.discard(future)
+    try:
+        filename = future.result()
+    except Exception:
+        logging.exception('Browse figure could not be written')
+    else:
+        print(filename)
+
+
+def flush():
+    """ Wait for the browse figures being written to disk. Also called at exit
+    """
+    wait(list(_PENDING))
+
+
+atexit.register(flush)
+
+
+def _save(filename, arr):
+    """ Write a 2D array to npy, or to csv with the column numbers as header 
+    (same layout as pandas.DataFrame(arr).to_csv(index=False))
+    """
+    if filename.endswith('.npy'):
+        np.save(filename, arr)
+        return
+    
+    header = ','.join(str(i) for i in range(np.shape(arr)[1]))
+    np.savetxt(filename, arr, fmt='%.9g', delimiter=',', header=header, comments='')
+
+
+def simulation_integration(LRS, mat_filename, archive=False, delete=False, 
+                           archive_format='csv'):
     """ Integrates Chris' cluttergrams (.mat) into the hierarchy
+    archive_format is 'csv' (text) or 'npy' (binary numpy array, faster to 
+    write and read)
     """
     # Get Data
-    mat = scipy.io.loadmat(mat_filename)
-    name = mat_filename.split('Cluttersim_')[1].split('_')[0]
-    rdg = LRS.orig_data('sln-l-lrs-5-sndr-ss-high-v2.0', name)['IMG_pdb']
-    anc = LRS.anc_data('sln-l-lrs-5-sndr-ss-high-v2.0', name)
+    mat = scipy.io.loadmat(mat_filename, 
+                           variable_names=['RgramRCPWR', 'RgramFocPWR', 'Xindex'])
+    _, sep, tail = mat_filename.partition('Cluttersim_')
+    if not sep:
+        raise ValueError(f'{mat_filename} is not a Cluttersim_ file')
+    name = tail.partition('_')[0]
+    rdg = LRS.orig_data('sln-l-lrs-5-sndr-ss-high-v2.0', name, lazy=True)['IMG_pdb']
     
     # Padding
     padding_value = -202.9 # Same as in LRS orig data
-    ctg_blank = np.full((np.shape(mat['RgramRCPWR'])[0], np.shape(rdg)[1]), padding_value)
+    shape = (np.shape(mat['RgramRCPWR'])[0], np.shape(rdg)[1])
     
-    ctg_RCPWR = copy.deepcopy(ctg_blank)
-    ctg_FCPWR = copy.deepcopy(ctg_blank)
+    ctg_RCPWR = np.full(shape, padding_value, dtype=np.float32)
+    ctg_FCPWR = np.full(shape, padding_value, dtype=np.float32)
     
-    ctg_RCPWR[:,mat['Xindex'][0]] = mat['RgramRCPWR']
-    ctg_FCPWR[:,mat['Xindex'][0]] = mat['RgramFocPWR']
+    columns = _columns(mat['Xindex'][0])
+    ctg_RCPWR[:,columns] = mat['RgramRCPWR']
+    ctg_FCPWR[:,columns] = mat['RgramFocPWR']
     
     # Archive
     archive_path_RCPWR = os.path.join(LRS.xtra_path, 'sim', 'sln-l-lrs-5-sndr-ss-high-v2.0', name[:8] ,'data')
     archive_path_FCPWR = os.path.join(LRS.xtra_path, 'sim', 'sln-l-lrs-5-sndr-ss-nfoc-power-v1.0', name[:8] ,'data')
     
-    archive_fullname_RCPWR = os.path.join(archive_path_RCPWR, f'LRS_SWH_RV20_{name}_gerekos2018.csv')
-    archive_fullname_FCPWR = os.path.join(archive_path_FCPWR, f'LRS_NFOC_{name}_gerekos2018.csv')
+    archive_fullname_RCPWR = os.path.join(archive_path_RCPWR, f'LRS_SWH_RV20_{name}_gerekos2018.{archive_format}')
+    archive_fullname_FCPWR = os.path.join(archive_path_FCPWR, f'LRS_NFOC_{name}_gerekos2018.{archive_format}')
     
     if archive:
         # RCPWR
         archive_path = archive_path_RCPWR
         archive_fullname = archive_fullname_RCPWR
-        result = pd.DataFrame(ctg_RCPWR)
-        if not glob.glob(archive_fullname) or delete:
+        if delete or not os.path.exists(archive_fullname):
             os.makedirs(archive_path, exist_ok=True)
-            result.to_csv(archive_fullname, header=True, index=False)
+            _save(archive_fullname, ctg_RCPWR)
             logging.info(' ' + archive_fullname + ' CREATED')
         # FCPWR
         archive_path = archive_path_FCPWR
         archive_fullname = archive_fullname_FCPWR
-        result = pd.DataFrame(ctg_FCPWR)
-        if not glob.glob(archive_fullname) or delete:
+        if delete or not os.path.exists(archive_fullname):
             os.makedirs(archive_path, exist_ok=True)
-            result.to_csv(archive_fullname, header=True, index=False)
+            _save(archive_fullname, ctg_FCPWR)
             logging.info(' ' + archive_fullname + ' CREATED')
 
 
 
+def simulation_integration_batch(LRS, mat_filenames, archive=True, delete=False, 
+                                 n_jobs=4, verbose=6, prefer='processes', **kwargs):
+    """ Run simulation_integration on several cluttergrams (.mat) in parallel
+    
+    ARGUMENTS
+    ---------
+    prefer: string ('threads' or 'processes')
+        joblib backend preference. Each file is independent, and reading the
+        .mat and writing the archives is mostly CPU-bound, so processes are 
+        used by default
+    """
+    results = Parallel(n_jobs=n_jobs, verbose=verbose, prefer=prefer)(
+        delayed(simulation_integration)(LRS, mat_filename, archive=archive, 
+                                        delete=delete, **kwargs) 
+        for mat_filename in mat_filenames)
+    
+    return results
+
+
+
 def browse_figure(LRS, swh_name, latlim=[-80,-70], lonlim=[105, 160], cmap='gray_r', vmin=-10, vmax=40, archive=False, relative_shift=False,
                  background_map='../schrodinger/figures/browse_map_swh.jpg'):
     """ Generate a browse figure for a track across Schrodinger
@@ -72,30 +181,28 @@ def browse_figure(LRS, swh_name, latlim=[-80,-70], lonlim=[105, 160], cmap='gray
     import lrs
     LRS = lrs.Classdef.Env()
     schrodinger.browse_figure(LRS, '20080409215959')
+    
+    With archive=True, the figure is written to disk in the background and 
+    the Future of the write is returned (see also flush)
     """
     # --------
     # Get data
     # --------
     t = Classdef.Track(LRS, swh_name, latlim=latlim, lonlim=lonlim, relative_shift=relative_shift)
     
-    products = [t.swh['product'],
-                t.sar10['product'],
-                t.nfoc_sim['product'], ]
+    datas = [t.swh, t.sar10, t.nfoc_sim]
     
-    names = [t.swh['name'],
-             t.sar10['name'],
-             t.nfoc_sim['name'], ]
-    
-    rdgs = [t.swh['rdg'],
-            t.sar10['rdg'],
-            t.nfoc_sim['rdg'], ]
+    products = [data['product'] for data in datas]
+    names = [data['name'] for data in datas]
+    rdgs = [data['rdg'] for data in datas]
     
     # Figure
-    fig, axes = plt.subplot_mosaic(
-        [["map", "map", "map", "map", "map", products[0], products[0], products[0], products[0], products[0], products[0]],
-         ["map", "map", "map", "map", "map", products[1], products[1], products[1], products[1], products[1], products[1]],
-         ["map", "map", "map", "map", "map", products[2], products[2], products[2], products[2], products[2], products[2]]], 
-    )#figsize=(19,9), constrained_layout=True, dpi=500)
+    # Map on the 5 left columns, radargrams on the 6 right columns
+    fig = plt.figure()#figsize=(19,9), constrained_layout=True, dpi=500)
+    gs = fig.add_gridspec(3, 11)
+    axes = {'map':fig.add_subplot(gs[:, :5])}
+    for i, product in enumerate(products):
+        axes[product] = fig.add_subplot(gs[i, 5:])
     
     axes['map'].get_yaxis().set_visible(False)
     
@@ -114,13 +221,15 @@ def browse_figure(LRS, swh_name, latlim=[-80,-70], lonlim=[105, 160], cmap='gray
     # ----------
     
     cmap_range = 50
-    axes[products[0]].imshow(rdgs[0], cmap=cmap, vmin=-130, vmax=-130+cmap_range, )
-    axes[products[1]].imshow(rdgs[1], cmap=cmap, vmin=-10, vmax=-10+cmap_range, )
-    axes[products[2]].imshow(rdgs[2], cmap=cmap, vmin=-40, vmax=-40+cmap_range, )
+    for i, vmin_i in enumerate([-130, -10, -40]):
+        rdg, extent = _browse_rdg(rdgs[i])
+        axes[products[i]].imshow(rdg, cmap=cmap, vmin=vmin_i, vmax=vmin_i+cmap_range, 
+                                 extent=extent, interpolation='nearest')
     
+    yticks = np.linspace(0, 3000, 72, endpoint=False) # every 1000/24 bins
     for i in [0,1,2]:
         axes[products[i]].set_title(f'{products[i]} - {names[i]}', y=.86)
-        axes[products[i]].set_yticks(np.arange(0,3000, 1000/24))
+        axes[products[i]].set_yticks(yticks)
         axes[products[i]].set_yticklabels([])
         axes[products[i]].set_ylim([1000,0])
         if invertx:
@@ -143,7 +252,7 @@ def browse_figure(LRS, swh_name, latlim=[-80,-70], lonlim=[105, 160], cmap='gray
     else:
         axes['map'].plot(x[0], y[0], marker="o", markersize=10, color='white')
     
-    img = plt.imread(background_map)
+    img = _background(background_map)
     axes['map'].imshow(img, aspect='equal', extent=(100000, 550000, -550000, -100000))
 
     axes['map'].plot(x, y, color='white')
@@ -162,15 +271,18 @@ def browse_figure(LRS, swh_name, latlim=[-80,-70], lonlim=[105, 160], cmap='gray
     km_sampling = len(km)/km.max()
     km_marks = np.arange(0, km.max(), 50)
     
-    for km_mark in km_marks:
-        # Markers on radargrams
-        axes[products[0]].axvline(x = km_mark*km_sampling, color = 'k', ls = '--', alpha=.5, lw=.5)
-        axes[products[1]].axvline(x = km_mark*km_sampling, color = 'k', ls = '--', alpha=.5, lw=.5)
-        axes[products[2]].axvline(x = km_mark*km_sampling, color = 'k', ls = '--', alpha=.5, lw=.5)
-        # Markers on map
-        idx_mark = int(km_mark*km_sampling)
-        axes['map'].plot(x[idx_mark], y[idx_mark], marker=(2,0,mark_angle), 
-                         markersize=10, markeredgecolor="w", markerfacecolor="w")
+    positions = km_marks*km_sampling
+    indices = positions.astype(np.int64)
+    
+    # Markers on radargrams (full height, as axvline)
+    for product in products:
+        ax = axes[product]
+        ax.vlines(positions, 0, 1, transform=ax.get_xaxis_transform(), 
+                  color = 'k', ls = '--', alpha=.5, lw=.5)
+    # Markers on map
+    axes['map'].plot(np.asarray(x)[indices], np.asarray(y)[indices], ls='none', 
+                     marker=(2,0,mark_angle), markersize=10, 
+                     markeredgecolor="w", markerfacecolor="w")
     
     
     # -------
@@ -190,7 +302,12 @@ def browse_figure(LRS, swh_name, latlim=[-80,-70], lonlim=[105, 160], cmap='gray
         filename = f'LRS_schrodinger_{str(int(maxlon*1000)).zfill(6)[:6]}{suffix}.jpg'
         archive_path = os.path.join('..', 'schrodinger', 'browse', filename)
         #print(archive_path)
-        plt.savefig(archive_path, dpi=500)
-        print(archive_path)
+        # Encode here, write to disk in the background
+        buf = io.BytesIO()
+        fig.savefig(buf, format='jpg', dpi=500)
+        future = _IO_POOL.submit(_write, archive_path, buf.getvalue())
+        _PENDING.add(future)
+        future.add_done_callback(_written)
         plt.clf()
-        plt.close()
\ No newline at end of file
+        plt.close()
+        return future
\ No newline at end of file
@@ -1,5 +1,4 @@
 import numpy as np
-import pyproj
 
 def intermediate_latlon(lat_lim, lon_lim, sampling=10e3):
     """ Provide intermediate points along a great circle
@@ -17,27 +16,64 @@ def intermediate_latlon(lat_lim, lon_lim, sampling=10e3):
     ------
     latlon
     """
-    # calculate distance between points
-    g = pyproj.Geod(a=1737400, b=1737400) # Moon equatorial and polar radius
-    (az12, az21, dist) = g.inv(lon_lim[0], lat_lim[0], lon_lim[1], lat_lim[1])
-
-    # find "npts" points equally spaced by "sampling" meters
-    npts = dist/sampling
-    del_s = sampling
-    r = g.fwd_intermediate(lon_lim[0], lat_lim[0], az12, npts=npts, del_s=del_s)
-
-    # Output structure
-    lon360s = [lon + 360 if lon < 0 else lon for lon in r.lons]
-    lats = [lat for lat in r.lats]
-    #latlons = [[r.lats[i], lon360s[i]] for i in np.arange(r.npts)]
+    # Spherical Moon: closed-form great circle interpolation
+    r = intermediate_latlons([lat_lim], [lon_lim], sampling=sampling)
+    
+    return {'lats':r['lats'], 'lons':r['lons']}
 
-    # Append first and last coordinates of the track
-    lon360s.insert(0, lon_lim[0])
-    lats.insert(0, lat_lim[0])
-    lon360s.append(lon_lim[1])
-    lats.append(lat_lim[1])
+def intermediate_latlons(lat_lims, lon_lims, sampling=10e3, radius=1737400):
+    """ Provide intermediate points along the great circles of several tracks 
+    at once. Points are the same as pyproj.Geod.fwd_intermediate on a sphere,
+    computed by spherical linear interpolation (slerp) for all tracks in a 
+    single pass
+    
+    ARGUMENTS
+    ---------   
+    lat_lims: array (n, 2)
+        Latitude of first and last points of each track
+    lon_lims: array (n, 2)
+        Longitude of first and last points of each track
+    sampling: integer
+        space between points [m]
+    radius: float
+        Sphere radius [m] (Moon by default)
+    
+    RETURN
+    ------
+    {'lats', 'lons', 'starts'}, with starts the index of the first point of 
+    each track
+    """
+    lat_lims = np.asarray(lat_lims, dtype=np.float64).reshape(-1, 2)
+    lon_lims = np.asarray(lon_lims, dtype=np.float64).reshape(-1, 2)
+    
+    # End points as unit vectors
+    lat, lon = np.radians(lat_lims), np.radians(lon_lims)
+    p = np.stack([np.cos(lat)*np.cos(lon), np.cos(lat)*np.sin(lon), np.sin(lat)], 
+                 axis=-1)
+    p0, p1 = p[:,0,:], p[:,1,:]
+    omega = np.arccos(np.clip(np.sum(p0*p1, axis=-1), -1, 1))
+    
+    # Intermediate points every "sampling" meters from the first point
+    n = (omega*radius/sampling).astype(int)
+    track = np.repeat(np.arange(len(n)), n)
+    k = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n) + 1
+    angle = k*sampling/radius
+    w0 = np.sin(omega[track] - angle)/np.sin(omega[track])
+    w1 = np.sin(angle)/np.sin(omega[track])
+    q = w0[:,None]*p0[track] + w1[:,None]*p1[track]
+    
+    # Output structure with the first and last coordinates of each track
+    counts = n + 2
+    starts = np.cumsum(counts) - counts
+    interior = np.ones(counts.sum(), dtype=bool)
+    interior[starts] = False
+    interior[starts + counts - 1] = False
     
-    #latlons.insert(0, (lat_lim[0], lon_lim[0]))
-    #latlons.append((lat_lim[1], lon_lim[1]))
+    lats = np.empty(counts.sum())
+    lons = np.empty(counts.sum())
+    lats[interior] = np.degrees(np.arcsin(np.clip(q[:,2], -1, 1)))
+    lons[interior] = np.degrees(np.arctan2(q[:,1], q[:,0])) % 360
+    lats[starts], lons[starts] = lat_lims[:,0], lon_lims[:,0]
+    lats[starts + counts - 1], lons[starts + counts - 1] = lat_lims[:,1], lon_lims[:,1]
     
-    return {'lats':lats, 'lons':lon360s}
\ No newline at end of file
+    return {'lats':lats, 'lons':lons, 'starts':starts}